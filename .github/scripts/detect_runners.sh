@@ -27,7 +27,9 @@ CATEGORIES=(generic rdma)
 declare -A RUNNERS_PER_WORKFLOW=(
   # Keep in sync with the number of shr_generic_rank matrix entries in
   # spdk-common-tests.yml; adding one without bumping this lets concurrent
-  # gerrit-webhook-handler workflows overcommit shr_generic.
+  # gerrit-webhook-handler workflows overcommit shr_generic.  The forwarder
+  # dispatches against the same model, see FORWARDER_RUNNERS_PER_WORKFLOW
+  # in infra/README.md.
   [generic]=2
 )
 
@@ -1,126 +1,267 @@
 #!/usr/bin/env python3
 
 import os
+import json
 import logging
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from pygerrit2 import GerritRestAPI, HTTPBasicAuth
+from pygerrit2 import HTTPBasicAuth
+import gerrit_client
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 GERRIT_USERNAME = os.getenv("GERRIT_USERNAME")
 GERRIT_PASSWORD = os.getenv("GERRIT_PASSWORD")
 GERRIT_BASE_URL = os.getenv("GERRIT_BASE_URL", "https://review.spdk.io")
+# Reviews are posted by REVIEW_WORKERS threads, at most REVIEW_RATE per second
+# on average.  Up to REVIEW_BURST of them may go out back to back after a
+# pause, e.g. at the start of the run.
+REVIEW_WORKERS = int(os.getenv("REVIEW_WORKERS", "4"))
+REVIEW_RATE = float(os.getenv("REVIEW_RATE", "2"))
+REVIEW_BURST = int(os.getenv("REVIEW_BURST", "4"))
+BRANCH_FETCH_WORKERS = 8
+# We don't want VERY old changes to flood Gerrit dashboard, so changes this
+# much older than their branch tip are not warned about.
+TOO_OLD = timedelta(weeks=12)
+# Warnings posted by previous runs; the workflow keeps the file in the Actions cache
+LEDGER_PATH = os.getenv("OUTDATED_CHANGES_LEDGER", "outdated_changes_ledger.json")
+
+class TokenBucket:
+    """Rate limiter allowing `rate` acquisitions per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class WarningLedger:
+    """Warnings known to be posted, keyed by (change, revision number, severity).
+
+    Answers "was this warning already posted?" without fetching the change's
+    messages.  Only warnings found by this run (posted or spotted in the
+    messages) are added, and entries of changes this run did not see (closed
+    or too old) are dropped on save, so the file stays as small as the set of
+    candidate changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = set()
+        try:
+            with open(path) as f:
+                self.entries = {tuple(entry) for entry in json.load(f)}
+            logging.info(f"Loaded {len(self.entries)} warnings from {path}")
+        except FileNotFoundError:
+            logging.info(f"No warning ledger at {path}, starting a new one")
+        except (ValueError, TypeError) as e:
+            logging.warning(f"Ignoring unreadable warning ledger {path}: {e}")
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, key):
+        self.entries.add(key)
+
+    def save(self, open_changes):
+        entries = sorted(entry for entry in self.entries if entry[0] in open_changes)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            # Keep the previous ledger and leave no stray temp file behind
+            os.unlink(tmp_path)
+            raise
+        logging.info(f"Saved {len(entries)} warnings to {self.path}")
 
 def parse_datetime(datetime_str):
     return datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S.%f000").replace(tzinfo=timezone.utc)
 
-def get_open_changes(gerrit):
-    query = "".join([
-        "/changes/",
-        "?q=project:spdk/spdk status:open -is:private -is:wip",
-        "&o=CURRENT_REVISION&o=MESSAGES",
-    ])
+def get_candidate_changes(gerrit):
+    """Return the open changes updated within TOO_OLD, the only ones process_changes() may warn about."""
+    # after: compares against the change's last update, which is never older
+    # than its current patch set, so this drops only changes whose patch set
+    # is more than TOO_OLD old.  On a current branch tip they are too old
+    # already; on a branch whose tip is itself old they are the VERY old
+    # changes TOO_OLD is meant to keep off the dashboard.  Only the branches
+    # of the remaining changes then need their tip date.  There is no
+    # operator for the patch set date, and the update time moves with every
+    # comment (including our own warnings), so the exact windows are still
+    # applied client side.
+    since = (datetime.now(timezone.utc) - TOO_OLD).strftime("%Y-%m-%d %H:%M:%S %z")
+    query = f'project:spdk/spdk status:open -is:private -is:wip after:"{since}"'
     logging.info(f"Querying Gerrit with: {query}")
-    return gerrit.get(query)
+    return list(gerrit_client.query_changes(gerrit, query, ["CURRENT_REVISION"]))
 
-def get_branch_tip_date(gerrit, branch):
+def get_commit_date(gerrit, revision):
     try:
-        query = f"/projects/spdk%2Fspdk/branches/{branch.replace('.', '%2E')}"
-        logging.info(f"Querying Gerrit for branch tip: {query}")
-
-        branch_info = gerrit.get(query)
-        latest_revsion = branch_info.get("revision")
-
-        query = f"/projects/spdk%2Fspdk/commits/{latest_revsion}"
-        commit_info = gerrit.get(query)
+        commit_info = gerrit.get(f"/projects/spdk%2Fspdk/commits/{revision}")
         commit_date_str = commit_info.get("committer", {}).get("date")
 
         if not commit_date_str:
-            logging.warning(f"No commit date found for branch {branch}.")
+            logging.warning(f"No commit date found for commit {revision}.")
             return None
 
         return parse_datetime(commit_date_str)
     except Exception as e:
-        logging.error(f"Failed to get branch tip date for {branch}: {e}")
+        logging.error(f"Failed to get commit date for {revision}: {e}")
         return None
 
-def get_current_patch_comments(messages, current_revision_number):
-    comments = []
-    for message in messages:
-        if message.get("_revision_number") == current_revision_number:
-            comments.append(message["message"])
-    return comments
+def get_branch_tip_dates(gerrit, branches):
+    """Return {branch: tip commit date} for the given branches, fetching the tip commits concurrently."""
+    query = "/projects/spdk%2Fspdk/branches/"
+    logging.info(f"Querying Gerrit for branch tips: {query}")
+    refs = {f"refs/heads/{branch}" for branch in branches}
+    tips = {branch["ref"].removeprefix("refs/heads/"): branch["revision"]
+            for branch in gerrit.get(query) if branch["ref"] in refs}
+
+    with ThreadPoolExecutor(max_workers=BRANCH_FETCH_WORKERS) as executor:
+        dates = dict(zip(tips, executor.map(lambda revision: get_commit_date(gerrit, revision), tips.values())))
+    for branch, date in dates.items():
+        logging.info(f"Saved branch tip date for {branch}: {date}")
+    return dates
+
+def was_warned(gerrit, change_id, current_revision_number, message_substr):
+    """Check the change's messages for a warning already posted on its current revision."""
+    messages = gerrit.get(f"/changes/{change_id}/messages")
+    return any(message.get("_revision_number") == current_revision_number and message_substr in message["message"]
+               for message in messages)
+
+def warn(gerrit, change_id, current_revision_number, message, message_substr, vote, limiter):
+    """Post the warning unless the change's messages show it was already posted; returns the outcome."""
+    try:
+        if was_warned(gerrit, change_id, current_revision_number, message_substr):
+            return "already warned"
+    except Exception as e:
+        logging.error(f"Failed to get messages of change {change_id}: {e}")
+        return "failed to post"
+    if not send_comment(gerrit, change_id, message + message_substr, vote, limiter):
+        return "failed to post"
+    return "warned" if vote is None else "warned with Verified -1"
 
-def process_changes(gerrit, changes):
-    branch_tip_dates = {}
+def process_changes(gerrit, changes, branch_tip_dates, ledger):
+    """Warn the owners of outdated changes; returns {change number: outcome}."""
     two_weeks = timedelta(weeks=2)
     four_weeks = timedelta(weeks=4)
-    twelve_weeks = timedelta(weeks=12)
-
-    for change in changes:
-        change_id = change.get("_number")
-        project = change.get("project")
-        branch = change.get("branch")
-        subject = change.get("subject", "N/A")
-        owner = change.get("owner", {}).get("name", "Unknown")
-        url = os.path.join(GERRIT_BASE_URL, "c", project, '+', str(change_id))
-        revisions = change.get("revisions", {})
-        current_revision = next(iter(revisions.values()), {})
-        current_revision_number = change.get("current_revision_number")
-        created_str = current_revision.get("created")
-
-        if not created_str:
-            logging.warning(f"Change {change_id} has no 'created' field in the current revision.")
-            continue
-        created = parse_datetime(created_str)
-
-        if branch_tip_dates.get(branch):
-            branch_tip_date = branch_tip_dates[branch]
-        else:
-            branch_tip_date = get_branch_tip_date(gerrit, branch)
-            branch_tip_dates[branch] = branch_tip_date
-            logging.info(f"Saved branch tip date for {branch}: {branch_tip_date}")
-
-        time_since_branch_tip = branch_tip_date - created
-        if time_since_branch_tip <= timedelta(0):
-            # Change is newer than branch tip; skip it.
-            continue
-        if time_since_branch_tip > twelve_weeks:
-            # Change is older than twelve weeks; we don't want VERY old changes to flood Gerrit dashboard,
-            # so skip them.
-            continue
-
-        existing_comments = get_current_patch_comments(change["messages"], current_revision_number)
-
-        logging.info(f"Processing change {url} - {subject} by {owner}")
-        logging.info(f"Time since last update: {time_since_branch_tip.days} days")
-        message = "OUTDATED PATCH WARNING: Your change has not been updated for at least"
-        message += f" {time_since_branch_tip.days // 7} weeks ({time_since_branch_tip.days} days)."
-        if time_since_branch_tip > four_weeks:
-            message_substr = " This makes it severely outdated. Please rebase your change."
-            if any(message_substr in comment for comment in existing_comments):
-                # We already sent this comment, skip.
+    outcomes = {}
+    posts = {}
+    limiter = TokenBucket(REVIEW_RATE, REVIEW_BURST)
+
+    with ThreadPoolExecutor(max_workers=REVIEW_WORKERS) as executor:
+        for change in changes:
+            change_id = change.get("_number")
+            project = change.get("project")
+            branch = change.get("branch")
+            subject = change.get("subject", "N/A")
+            owner = change.get("owner", {}).get("name", "Unknown")
+            url = os.path.join(GERRIT_BASE_URL, "c", project, '+', str(change_id))
+            revisions = change.get("revisions", {})
+            current_revision = next(iter(revisions.values()), {})
+            current_revision_number = change.get("current_revision_number")
+            created_str = current_revision.get("created")
+
+            if not created_str:
+                logging.warning(f"Change {change_id} has no 'created' field in the current revision.")
+                outcomes[change_id] = "no creation date"
+                continue
+            created = parse_datetime(created_str)
+
+            branch_tip_date = branch_tip_dates.get(branch)
+            if branch_tip_date is None:
+                outcomes[change_id] = "unknown branch tip"
+                continue
+
+            time_since_branch_tip = branch_tip_date - created
+            if time_since_branch_tip <= timedelta(0):
+                # Change is newer than branch tip; skip it.
+                outcomes[change_id] = "up to date"
                 continue
-            message += message_substr
-            send_comment(gerrit, change_id, message, -1)
-        elif time_since_branch_tip > two_weeks:
-            message_substr = " Please consider rebasing, make sure you're working with latest code base."
-            if any(message_substr in comment for comment in existing_comments):
+            if time_since_branch_tip > TOO_OLD:
+                # Change is older than twelve weeks; skip it.
+                outcomes[change_id] = "too old"
+                continue
+
+            logging.info(f"Processing change {url} - {subject} by {owner}")
+            logging.info(f"Time since last update: {time_since_branch_tip.days} days")
+            message = "OUTDATED PATCH WARNING: Your change has not been updated for at least"
+            message += f" {time_since_branch_tip.days // 7} weeks ({time_since_branch_tip.days} days)."
+            if time_since_branch_tip > four_weeks:
+                message_substr = " This makes it severely outdated. Please rebase your change."
+                vote = -1
+                severity = "severe"
+            elif time_since_branch_tip > two_weeks:
+                message_substr = " Please consider rebasing, make sure you're working with latest code base."
+                vote = None
+                severity = "warning"
+            else:
+                outcomes[change_id] = "recently updated"
+                continue
+            key = (change_id, current_revision_number, severity)
+            if key in ledger:
                 # We already sent this comment, skip.
+                outcomes[change_id] = "already warned"
                 continue
-            message += message_substr
-            send_comment(gerrit, change_id, message, None)
+            # Not in the ledger, e.g. posted by hand or before the ledger
+            # existed: look at the change's messages before posting.
+            posts[key] = executor.submit(warn, gerrit, change_id, current_revision_number,
+                                         message, message_substr, vote, limiter)
+
+        for key, post in posts.items():
+            outcomes[key[0]] = post.result()
+            if outcomes[key[0]] != "failed to post":
+                ledger.add(key)
 
-def send_comment(gerrit, change_id, message, vote):
+    return outcomes
+
+def send_comment(gerrit, change_id, message, vote, limiter):
     json_data = {"message": message}
     if vote is not None:
         json_data["labels"] = {"Verified": vote}
 
+    limiter.acquire()
     logging.info(f"Sending comment to change {change_id}: {message} (Verified={vote})")
     try:
         gerrit.post(f"/changes/{change_id}/revisions/current/review", json=json_data)
         logging.info(f"Comment sent successfully to change {change_id}.")
+        return True
     except Exception as e:
         logging.error(f"Failed to send comment to change {change_id}: {e}")
+        return False
+
+def report_summary(outcomes):
+    counts = Counter(outcomes.values())
+    lines = [f"{outcome}: {count}" for outcome, count in sorted(counts.items())]
+    logging.info(f"Processed {len(outcomes)} changes: " + ", ".join(lines))
+    failed = sorted(change_id for change_id, outcome in outcomes.items() if outcome == "failed to post")
+    if failed:
+        logging.error(f"Failed to post to changes: {', '.join(map(str, failed))}")
+
+    summary_path = os.getenv("GITHUB_STEP_SUMMARY")
+    if summary_path:
+        with open(summary_path, "a") as f:
+            f.write(f"### Outdated changes scan\n\n{len(outcomes)} open changes processed\n\n")
+            f.write("| Outcome | Changes |\n|---|---|\n")
+            f.writelines(f"| {outcome} | {count} |\n" for outcome, count in sorted(counts.items()))
+            if failed:
+                f.write(f"\nFailed to post to: {', '.join(map(str, failed))}\n")
 
 def main():
     logging.basicConfig(
@@ -129,11 +270,15 @@ def main():
     )
 
     auth = HTTPBasicAuth(GERRIT_USERNAME, GERRIT_PASSWORD)
-    gerrit = GerritRestAPI(url=GERRIT_BASE_URL, auth=auth)
+    gerrit = gerrit_client.connect(GERRIT_BASE_URL, auth=auth)
 
     try:
-        changes = get_open_changes(gerrit)
-        process_changes(gerrit, changes)
+        ledger = WarningLedger(LEDGER_PATH)
+        changes = get_candidate_changes(gerrit)
+        branch_tip_dates = get_branch_tip_dates(gerrit, {change.get("branch") for change in changes})
+        outcomes = process_changes(gerrit, changes, branch_tip_dates, ledger)
+        ledger.save(outcomes.keys())
+        report_summary(outcomes)
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         exit(1)
@@ -0,0 +1,124 @@
+"""Regression tests for outdated_changes.py.
+
+Run from .github/scripts with PYTHONPATH=../../infra/common:
+    python3 -m unittest test_outdated_changes
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import outdated_changes
+
+
+class WarningLedgerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(self.directory, "ledger.json")
+
+    def test_round_trip(self):
+        ledger = outdated_changes.WarningLedger(self.path)
+        ledger.add((1, 2, "severe"))
+        ledger.add((3, 1, "warning"))
+        ledger.save({1, 3})
+
+        loaded = outdated_changes.WarningLedger(self.path)
+        # JSON has no tuples; entries must come back as hashable keys
+        self.assertIn((1, 2, "severe"), loaded)
+        self.assertIn((3, 1, "warning"), loaded)
+        self.assertNotIn((1, 2, "warning"), loaded)
+
+    def test_save_drops_changes_no_longer_open(self):
+        ledger = outdated_changes.WarningLedger(self.path)
+        ledger.add((1, 2, "severe"))
+        ledger.add((3, 1, "warning"))
+        ledger.save({3})
+
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), [[3, 1, "warning"]])
+
+    def test_unreadable_ledger_starts_empty(self):
+        for content in ("not json", "5"):
+            with open(self.path, "w") as f:
+                f.write(content)
+            with self.assertLogs(level="WARNING"):
+                ledger = outdated_changes.WarningLedger(self.path)
+            self.assertEqual(ledger.entries, set())
+
+    def test_failed_save_keeps_previous_ledger(self):
+        ledger = outdated_changes.WarningLedger(self.path)
+        ledger.add((1, 2, "severe"))
+        ledger.save({1})
+        ledger.add((3, 1, "warning"))
+
+        with mock.patch.object(outdated_changes.json, "dump", side_effect=TypeError("not serializable")):
+            with self.assertRaises(TypeError):
+                ledger.save({1, 3})
+
+        self.assertEqual(os.listdir(self.directory), ["ledger.json"])
+        self.assertEqual(outdated_changes.WarningLedger(self.path).entries, {(1, 2, "severe")})
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.sleeps = []
+        patches = [mock.patch.object(outdated_changes.time, "monotonic", lambda: self.now),
+                   mock.patch.object(outdated_changes.time, "sleep", self.sleep)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_bursts_then_paces(self):
+        limiter = outdated_changes.TokenBucket(rate=2, burst=3)
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(self.sleeps, [0.5, 0.5])
+
+    def test_idle_time_refills_up_to_burst(self):
+        limiter = outdated_changes.TokenBucket(rate=2, burst=3)
+        for _ in range(3):
+            limiter.acquire()
+        self.now += 60
+
+        for _ in range(4):
+            limiter.acquire()
+        self.assertEqual(self.sleeps, [0.5])
+
+
+class BranchTipDatesTest(unittest.TestCase):
+    def test_fetches_only_given_branch_tips(self):
+        commits = {"abc": "2026-01-05 10:00:00.000000000", "def": "2025-06-01 08:30:00.000000000"}
+
+        def get(path):
+            if path.endswith("/branches/"):
+                return [{"ref": "HEAD", "revision": "master"},
+                        {"ref": "refs/heads/master", "revision": "abc"},
+                        {"ref": "refs/heads/v25.01.x", "revision": "def"},
+                        {"ref": "refs/heads/v20.01.x", "revision": "123"}]
+            return {"committer": {"date": commits[path.rsplit("/", 1)[1]]}}
+
+        gerrit = mock.Mock(get=mock.Mock(side_effect=get))
+        dates = outdated_changes.get_branch_tip_dates(gerrit, {"master", "v25.01.x"})
+
+        self.assertEqual(dates, {
+            "master": outdated_changes.parse_datetime(commits["abc"]),
+            "v25.01.x": outdated_changes.parse_datetime(commits["def"]),
+        })
+        self.assertEqual(gerrit.get.call_count, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,21 +18,53 @@ Using the the 'ng' device-handle, as it is always available, whereas 'nvme' are
 only for block-devices. Regardless, the above is just to illustrate one
 possible "appearance" of the devices in Linux.
 
+The layout is picked by '--nvme_setup' among the topologies in
+NVME_TOPOLOGIES and in the config under 'qemu.nvme_topologies'.
+
+The namespaces are backed by raw images in the guest directory, created
+sparse unless '--nvme_img_alloc=full' is given. With '--nvme_img_pool' the
+raw images live in a directory kept across guest boots instead. With
+'--nvme_img_cache' every namespace is a qcow2 overlay on a zeroed base image
+kept in the given directory; the overlays are recreated on every start, so
+each run begins with blank namespaces without reallocating any storage.
+
 Retargetable: false
 -------------------
 """
 import errno
 import logging as log
+import os
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from cijoe.qemu.wrapper import Guest
+from cijoe.qemu.wrapper import Guest, qemu_img
 
 
 def add_args(parser: ArgumentParser):
     parser.add_argument("--guest_name", type=str, default=None)
     parser.add_argument("--nvme_img_root", type=str, default=None)
     parser.add_argument("--nvme_setup", type=str, default=None)
+    parser.add_argument(
+        "--nvme_img_alloc",
+        type=str,
+        choices=["sparse", "full"],
+        default="sparse",
+        help="Create drive images sparse, or with all blocks allocated up front",
+    )
+    images = parser.add_mutually_exclusive_group()
+    images.add_argument(
+        "--nvme_img_pool",
+        type=str,
+        default=None,
+        help="Directory of drive images kept across guest boots, shared by all nvme_setups",
+    )
+    images.add_argument(
+        "--nvme_img_cache",
+        type=str,
+        default=None,
+        help="Directory of zeroed base images; drives become qcow2 overlays reset on every start",
+    )
 
 
 class QemuNvme:
@@ -57,7 +89,7 @@ class QemuNvme:
 
 
     @staticmethod
-    def generate_controller(id, serial, mdts, downstream_bus, upstream_bus, controller_slot, subsystem=None):
+    def generate_controller(id, serial, mdts, downstream_bus, upstream_bus, controller_slot, subsystem=None, aux={}):
         args = {
             "id": id,
             "serial": serial,
@@ -67,6 +99,7 @@ class QemuNvme:
         }
         if subsystem:
             args["subsys"] = subsystem
+        args.update(aux)
 
         return [
             "-device",
@@ -78,17 +111,22 @@ class QemuNvme:
 
 
     @staticmethod
-    def generate_namespace(controller_id, nsid, lbads, nvme_img_root, aux={}):
-        """Returns qemu-arguments for a namespace configuration"""
+    def generate_namespace(controller_id, nsid, lbads, nvme_img_root, aux={}, img_format="raw", drive_aux={}):
+        """
+        Returns qemu-arguments for a namespace configuration
+        @param aux Auxilary nvme-ns arguments, e.g. {ms: 8, pi: 1}
+        @param drive_aux Auxilary -drive arguments, e.g. {aio: io_uring, cache: none}
+        """
 
         drive_id = f"{controller_id}n{nsid}"
         drive = {
             "id": drive_id,
-            "file": str(nvme_img_root / f"{drive_id}.img"),
-            "format": "raw",
+            "file": str(nvme_img_root / f"{drive_id}.{'img' if img_format == 'raw' else img_format}"),
+            "format": img_format,
             "if": "none",
             "discard": "on",
             "detect-zeroes": "unmap",
+            **drive_aux,
         }
 
         controller_namespace = {
@@ -110,259 +148,368 @@ class QemuNvme:
             ),
         ]
 
+    # One xio3130 switch, whose downstream ports share a single bus
+    MAX_CONTROLLERS = 32
+    MAX_NAMESPACES = 256
+    DRIVE_AIO = ["threads", "native", "io_uring"]
+    DRIVE_CACHE = ["none", "directsync", "writeback", "writethrough", "unsafe"]
+    # Set by generate_namespace() itself
+    DRIVE_RESERVED = ["id", "file", "format", "if"]
 
-def qemu_nvme_args(nvme_img_root):
-    """
-    Returns list of drive-args, a string of qemu-arguments and drive size for each namespace
-
-    @returns drives, args, drive_size
-    """
-
-    lbads = 12
-    drive_size = "8G"
-
-    drives = []
-
-    # NVMe configuration arguments
-    nvme = []
-    nvme += ["-device", "pcie-root-port,id=pcie_root_port1,chassis=1,slot=1"]
-
-    upstream_bus = "pcie_upstream_port1"
-    nvme += ["-device", f"x3130-upstream,id={upstream_bus},bus=pcie_root_port1"]
-
-    #
-    # Nvme0 - Controller for functional verification of namespaces with NVM and ZNS
-    # command-sets
-    #
-    controller_id1 = "nvme0"
-    controller_bus1 = "pcie_downstream_port1"
-    controller_slot1 = 1
-    nvme += QemuNvme.generate_controller(
-        controller_id1, "deadbeef", 7, controller_bus1, upstream_bus, controller_slot1
-    )
-
-    # Nvme0n1 - NVM namespace
-    drive1, qemu_nvme_dev1 = QemuNvme.generate_namespace(controller_id1, 1, lbads, nvme_img_root)
-    nvme += qemu_nvme_dev1
-    drives.append(drive1)
-
-    # Nvme0n2 - ZNS namespace
-    zoned_attributes = {
-        "zoned": "off",
-    }
-
-    drive2, qemu_nvme_dev2 = QemuNvme.generate_namespace(controller_id1, 2, lbads, nvme_img_root, zoned_attributes)
-    nvme += qemu_nvme_dev2
-    drives.append(drive2)
-
-    # Nvme1 - Controller dedicated to Fabrics testing
-    controller_id2 = "nvme1"
-    controller_bus2 = "pcie_downstream_port2"
-    controller_slot2 = 2
-    nvme += QemuNvme.generate_controller(
-        controller_id2, "adcdbeef", 7, controller_bus2, upstream_bus, controller_slot2
-    )
-
-    # Nvme1n1 - Namespace with NVM command-set
-    drive3, qemu_nvme_dev3 = QemuNvme.generate_namespace(controller_id2, 1, lbads, nvme_img_root)
-    nvme += qemu_nvme_dev3
-    drives.append(drive3)
-
-    # Nvme2 - Controller dedicated to testing HUGEPAGES / Large MDTS
-    controller_id3 = "nvme2"
-    controller_bus3 = "pcie_downstream_port3"
-    controller_slot3 = 3
-    nvme += QemuNvme.generate_controller(
-        controller_id3, "beefcace", 0, controller_bus3, upstream_bus, controller_slot3
-    )
-
-    # Nvme2n1 - NVM namespace
-    drive4, qemu_nvme_dev4 = QemuNvme.generate_namespace(controller_id3, 1, lbads, nvme_img_root)
-    nvme += qemu_nvme_dev4
-    drives.append(drive4)
-
-    #
-    # Nvme4 - Controller with PI enabled
-    #
-
-    controller_id5 = "nvme4"
-    controller_bus5 = "pcie_downstream_port5"
-    controller_slot5 = 5
-    nvme += QemuNvme.generate_controller(
-        controller_id5, "feebdaed", 7, controller_bus5, upstream_bus, controller_slot5
-    )
+    @staticmethod
+    def validate_topology(topology):
+        """Raises ValueError describing the first problem found in a topology"""
+
+        # Types are checked before values are compared, so that e.g. ms = "8"
+        # is reported as invalid instead of failing with a TypeError
+        def check_table(where, key, value):
+            if not isinstance(value, dict):
+                raise ValueError(f"{where}: {key} must be a table")
+
+        def check_tables(where, key, value):
+            if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+                raise ValueError(f"{where}: {key} must be a list of tables")
+
+        def check_int(where, key, value, low, high=None):
+            # TOML booleans are ints to Python, but never a valid number here
+            if (isinstance(value, bool) or not isinstance(value, int) or value < low
+                    or (high is not None and value > high)):
+                bounds = f"within [{low}, {high}]" if high is not None else f"at least {low}"
+                raise ValueError(f"{where}: invalid {key}({value!r}), must be an integer {bounds}")
+
+        def check_drive(where, drive):
+            reserved = set(drive) & set(QemuNvme.DRIVE_RESERVED)
+            if reserved:
+                raise ValueError(f"{where}: drive options {sorted(reserved)} cannot be set")
+            if drive.get("aio", "threads") not in QemuNvme.DRIVE_AIO:
+                raise ValueError(f"{where}: invalid aio({drive['aio']}), expected one of {QemuNvme.DRIVE_AIO}")
+            if drive.get("cache", "writeback") not in QemuNvme.DRIVE_CACHE:
+                raise ValueError(f"{where}: invalid cache({drive['cache']}), expected one of {QemuNvme.DRIVE_CACHE}")
+            if drive.get("aio") == "native" and drive.get("cache") not in ["none", "directsync"]:
+                raise ValueError(f"{where}: aio=native requires cache=none or cache=directsync")
+
+        if not isinstance(topology, dict):
+            raise ValueError("a topology must be a table")
+        unknown = set(topology) - {"drive_size", "lbads", "subsystems", "controller", "drive", "controllers"}
+        if unknown:
+            raise ValueError(f"unknown keys {sorted(unknown)}")
+        try:
+            if parse_size(str(topology["drive_size"])) <= 0:
+                raise ValueError
+        except (KeyError, IndexError, ValueError):
+            raise ValueError(f"invalid drive_size({topology.get('drive_size')})")
+
+        default_lbads = topology.get("lbads", 12)
+        check_int("topology", "lbads", default_lbads, 9, 16)
+        check_table("topology", "drive", topology.get("drive", {}))
+        check_drive("topology", topology.get("drive", {}))
+        check_table("topology", "controller", topology.get("controller", {}))
+        subsystems = topology.get("subsystems", {})
+        check_table("topology", "subsystems", subsystems)
+        for id, subsystem in subsystems.items():
+            check_table("topology", f"subsystems.{id}", subsystem)
+
+        controllers = topology.get("controllers")
+        check_tables("topology", "controllers", controllers)
+        if not controllers or len(controllers) > QemuNvme.MAX_CONTROLLERS:
+            raise ValueError(f"expected 1 to {QemuNvme.MAX_CONTROLLERS} controllers")
+
+        seen = {"id": set(), "serial": set(), "slot": set()}
+        for index, controller in enumerate(controllers):
+            controller = QemuNvme._controller_defaults(index, controller, topology.get("controller", {}))
+            for key in ["id", "serial"]:
+                if not isinstance(controller[key], str):
+                    raise ValueError(f"controller {index}: {key} must be a string")
+            check_int(controller["id"], "slot", controller["slot"], 1)
+            for key, values in seen.items():
+                if controller[key] in values:
+                    raise ValueError(f"duplicate controller {key}({controller[key]})")
+                values.add(controller[key])
+            check_int(controller["id"], "mdts", controller["mdts"], 0)
+            if controller.get("subsystem") is not None and controller["subsystem"] not in subsystems:
+                raise ValueError(f"{controller['id']}: unknown subsystem({controller['subsystem']})")
+            if not isinstance(controller.get("iothread", False), bool):
+                raise ValueError(f"{controller['id']}: iothread must be true or false")
+            for key in ["max_ioqpairs", "msix_qsize"]:
+                check_int(controller["id"], key, controller.get(key, 1), 1)
+
+            namespaces = controller.get("namespaces")
+            check_tables(controller["id"], "namespaces", namespaces)
+            if not namespaces:
+                raise ValueError(f"{controller['id']}: no namespaces")
+            nsids = set()
+            for namespace in namespaces:
+                nsid = namespace.get("nsid")
+                check_int(controller["id"], "nsid", nsid, 1, QemuNvme.MAX_NAMESPACES)
+                if nsid in nsids:
+                    raise ValueError(f"{controller['id']}: duplicate nsid({nsid})")
+                nsids.add(nsid)
+                where = f"{controller['id']}n{nsid}"
+                check_int(where, "lbads", namespace.get("lbads", default_lbads), 9, 16)
+                check_int(where, "ms", namespace.get("ms", 0), 0)
+                check_int(where, "pi", namespace.get("pi", 0), 0, 3)
+                if namespace.get("pi") and namespace.get("ms", 0) < 8:
+                    raise ValueError(f"{where}: pi requires ms >= 8")
+                check_table(where, "drive", namespace.get("drive", {}))
+                check_drive(where, {**topology.get("drive", {}), **namespace.get("drive", {})})
 
-    # Nvme4n1 - NVM namespace with PI type 1
-    drv_pi1, qemu_nvme_dev_pi1 = QemuNvme.generate_namespace(controller_id5, 1, lbads, nvme_img_root, {"ms": 8, "pi": 1})
-    nvme += qemu_nvme_dev_pi1
-    drives.append(drv_pi1)
+    @staticmethod
+    def _controller_defaults(index, controller, defaults):
+        return {
+            "id": f"nvme{index}",
+            "serial": f"spdk{index:04x}",
+            "mdts": 7,
+            "slot": index + 1,
+            **defaults,
+            **controller,
+        }
 
-    # Nvme4n2 - NVM namespace with PI type 2
-    drv_pi2, qemu_nvme_dev_pi2 = QemuNvme.generate_namespace(controller_id5, 2, lbads, nvme_img_root, {"ms": 8, "pi": 2})
-    nvme += qemu_nvme_dev_pi2
-    drives.append(drv_pi2)
+    @staticmethod
+    def compile_topology(topology, nvme_img_root, img_format="raw"):
+        """
+        Returns the drives and qemu-arguments of a topology, see NVME_TOPOLOGIES
 
-    # Nvme4n3 - NVM namespace with PI type 3
-    drv_pi3, qemu_nvme_dev_pi3 = QemuNvme.generate_namespace(controller_id5, 3, lbads, nvme_img_root, {"ms": 8, "pi": 3})
-    nvme += qemu_nvme_dev_pi3
-    drives.append(drv_pi3)
+        Raises ValueError when the topology is invalid.
 
-    return drives, nvme, drive_size
+        @returns drives, args
+        """
 
-def qemu_zns_nvme_args(nvme_img_root):
+        QemuNvme.validate_topology(topology)
+
+        def properties(attributes):
+            # TOML booleans become qemu's on/off
+            return {
+                k: ("on" if v else "off") if isinstance(v, bool) else v
+                for k, v in attributes.items()
+            }
+
+        nvme_img_root = Path(nvme_img_root)
+        default_lbads = topology.get("lbads", 12)
+        controller_defaults = topology.get("controller", {})
+        drive_defaults = properties(topology.get("drive", {}))
+        drives = []
+
+        args = []
+        for id, subsystem in topology.get("subsystems", {}).items():
+            aux = properties(subsystem)
+            args += QemuNvme.generate_subsystem(id, aux.pop("nqn", None), aux)
+
+        args += ["-device", "pcie-root-port,id=pcie_root_port1,chassis=1,slot=1"]
+        upstream_bus = "pcie_upstream_port1"
+        args += ["-device", f"x3130-upstream,id={upstream_bus},bus=pcie_root_port1"]
+
+        for index, controller in enumerate(topology["controllers"]):
+            controller = QemuNvme._controller_defaults(index, controller, controller_defaults)
+            namespaces = controller.pop("namespaces")
+            id, serial, mdts, slot = (controller.pop(k) for k in ["id", "serial", "mdts", "slot"])
+            subsystem = controller.pop("subsystem", None)
+            if controller.pop("iothread", False):
+                # Run the controller's I/O outside of QEMU's main loop
+                args += ["-object", f"iothread,id={id}_iothread"]
+                controller["iothread"] = f"{id}_iothread"
+            args += QemuNvme.generate_controller(
+                id, serial, mdts, f"pcie_downstream_port{slot}", upstream_bus, slot, subsystem,
+                properties(controller),
+            )
+
+            for namespace in namespaces:
+                aux = properties(namespace)
+                nsid = aux.pop("nsid")
+                lbads = aux.pop("lbads", default_lbads)
+                drive_aux = {**drive_defaults, **properties(aux.pop("drive", {}))}
+                drive, namespace_args = QemuNvme.generate_namespace(
+                    id, nsid, lbads, nvme_img_root, aux, img_format=img_format, drive_aux=drive_aux
+                )
+                args += namespace_args
+                drives.append(drive)
+
+        return drives, args
+
+
+# NVMe topologies selectable with --nvme_setup. More can be defined, or these
+# overridden, in the cijoe config under [qemu.nvme_topologies.<name>] using
+# the same layout:
+#
+# drive_size  -- size of every namespace's backing image, e.g. "8G"
+# lbads       -- default LBA data size, as a power of two
+# subsystems  -- optional {id: {nqn, ...}}; keys besides 'nqn' are nvme-subsys
+#                properties, e.g. fdp = "on"
+# controllers -- list of {id, serial, mdts, slot, subsystem, namespaces, ...};
+#                all but 'namespaces' are optional and other keys are nvme
+#                device properties
+# namespaces  -- list of {nsid, lbads, drive, ...}; other keys are nvme-ns
+#                properties, e.g. ms = 8, pi = 1 or "zoned.zone_size" = "32M"
+#
+# For example, four controllers sharing one subsystem, for NVMe-oF multipath
+# testing:
+#
+# [qemu.nvme_topologies.multipath]
+# drive_size = "4G"
+# subsystems.subsys0 = {nqn = "nqn.2019-08.io.spdk:multipath"}
+# controllers = [
+#   {subsystem = "subsys0", namespaces = [{nsid = 1, shared = true}]},
+#   {subsystem = "subsys0", namespaces = [{nsid = 2, shared = true}]},
+#   {subsystem = "subsys0", namespaces = [{nsid = 3, shared = true}]},
+#   {subsystem = "subsys0", namespaces = [{nsid = 4, shared = true}]},
+# ]
+#
+# Performance options:
+#
+# controller  -- defaults for every controller, e.g. max_ioqpairs = 8,
+#                msix_qsize = 9 or iothread = true; the latter gives each
+#                controller a dedicated iothread, which needs a QEMU whose
+#                nvme device has the 'iothread' property
+# drive       -- -drive options for every namespace, overridable by the
+#                namespace's own 'drive', e.g. aio = "io_uring" and
+#                cache = "none"; aio = "native" requires cache = "none"
+#
+# For example, multi-queue controllers with their own iothreads, and io_uring
+# drives bypassing the host page cache, added to a topology:
+#
+# controller = {max_ioqpairs = 8, msix_qsize = 9, iothread = true}
+# drive = {aio = "io_uring", cache = "none"}
+NVME_TOPOLOGIES = {
+    "default": {
+        "drive_size": "8G",
+        "lbads": 12,
+        "controllers": [
+            # Nvme0 - Controller for functional verification of namespaces with NVM and ZNS
+            # command-sets
+            {"id": "nvme0", "serial": "deadbeef", "mdts": 7, "slot": 1, "namespaces": [
+                {"nsid": 1},
+                {"nsid": 2, "zoned": "off"},
+            ]},
+            # Nvme1 - Controller dedicated to Fabrics testing
+            {"id": "nvme1", "serial": "adcdbeef", "mdts": 7, "slot": 2, "namespaces": [{"nsid": 1}]},
+            # Nvme2 - Controller dedicated to testing HUGEPAGES / Large MDTS
+            {"id": "nvme2", "serial": "beefcace", "mdts": 0, "slot": 3, "namespaces": [{"nsid": 1}]},
+            # Nvme4 - Controller with PI enabled, namespaces with PI type 1, 2 and 3
+            {"id": "nvme4", "serial": "feebdaed", "mdts": 7, "slot": 5, "namespaces": [
+                {"nsid": 1, "ms": 8, "pi": 1},
+                {"nsid": 2, "ms": 8, "pi": 2},
+                {"nsid": 3, "ms": 8, "pi": 3},
+            ]},
+        ],
+    },
+    "zns": {
+        "drive_size": "8G",
+        "lbads": 12,
+        "controllers": [
+            {"id": "nvme0", "serial": "deadbeef", "mdts": 7, "slot": 1, "namespaces": [
+                {"nsid": 1},
+                # ZNS namespace; zrwas and zrwafg are 32 and 16 blocks of 4K
+                {"nsid": 2, "zoned": "on", "zoned.zone_size": "32M", "zoned.zone_capacity": "28M",
+                 "zoned.max_active": 256, "zoned.max_open": 256, "zoned.zrwas": 131072,
+                 "zoned.zrwafg": 65536, "zoned.numzrwa": 256},
+            ]},
+            {"id": "nvme1", "serial": "adcdbeef", "mdts": 7, "slot": 2, "namespaces": [{"nsid": 1}]},
+            {"id": "nvme2", "serial": "beefcace", "mdts": 0, "slot": 3, "namespaces": [{"nsid": 1}]},
+            {"id": "nvme4", "serial": "feebdaed", "mdts": 7, "slot": 5, "namespaces": [
+                {"nsid": 1, "ms": 8, "pi": 1},
+                {"nsid": 2, "ms": 8, "pi": 2},
+                {"nsid": 3, "ms": 8, "pi": 3},
+            ]},
+        ],
+    },
+    "ftl": {
+        "drive_size": "20G",
+        "lbads": 12,
+        "controllers": [
+            # Nvme0 - Base device for FTL
+            {"id": "nvme0", "serial": "deadbeef", "mdts": 0, "slot": 1, "namespaces": [{"nsid": 1}]},
+            # Nvme1 - Cache device for FTL
+            {"id": "nvme1", "serial": "deadbeee", "mdts": 0, "slot": 2, "namespaces": [{"nsid": 1, "ms": 64}]},
+        ],
+    },
+}
+
+
+def parse_size(size):
+    """Returns the number of bytes in a qemu-img style size, e.g. '8G'"""
+
+    units = "KMGT"
+    suffix = size[-1].upper()
+    if suffix in units:
+        return int(size[:-1]) << (10 * (units.index(suffix) + 1))
+    return int(size)
+
+
+def provision_drive(path, size, preallocate):
     """
-    Returns list of drive-args, a string of qemu-arguments and drive size for each namespace
+    Make 'path' a raw image of 'size' bytes, creating or resizing it in-process
 
-    @returns drives, args, drive_size
+    @returns 0 on success, errno on error
     """
 
-    lbads = 12
-    drive_size = "8G"
-
-    drives = []
-
-    # NVMe configuration arguments
-    nvme = []
-    nvme += ["-device", "pcie-root-port,id=pcie_root_port1,chassis=1,slot=1"]
-
-    upstream_bus = "pcie_upstream_port1"
-    nvme += ["-device", f"x3130-upstream,id={upstream_bus},bus=pcie_root_port1"]
-
-    #
-    # Nvme0 - Controller for functional verification of namespaces with NVM and ZNS
-    # command-sets
-    #
-    controller_id1 = "nvme0"
-    controller_bus1 = "pcie_downstream_port1"
-    controller_slot1 = 1
-    nvme += QemuNvme.generate_controller(
-        controller_id1, "deadbeef", 7, controller_bus1, upstream_bus, controller_slot1
-    )
-
-    # Nvme0n1 - NVM namespace
-    drive1, qemu_nvme_dev1 = QemuNvme.generate_namespace(controller_id1, 1, lbads, nvme_img_root)
-    nvme += qemu_nvme_dev1
-    drives.append(drive1)
-
-    # Nvme0n2 - ZNS namespace
-    zoned_attributes = {
-        "zoned": "on",
-        "zoned.zone_size": "32M",
-        "zoned.zone_capacity": "28M",
-        "zoned.max_active": 256,
-        "zoned.max_open": 256,
-        "zoned.zrwas": 32 << lbads,
-        "zoned.zrwafg": 16 << lbads,
-        "zoned.numzrwa": 256,
-    }
-
-    drive2, qemu_nvme_dev2 = QemuNvme.generate_namespace(controller_id1, 2, lbads, nvme_img_root, zoned_attributes)
-    nvme += qemu_nvme_dev2
-    drives.append(drive2)
-
-    # Nvme1 - Controller dedicated to Fabrics testing
-    controller_id2 = "nvme1"
-    controller_bus2 = "pcie_downstream_port2"
-    controller_slot2 = 2
-    nvme += QemuNvme.generate_controller(
-        controller_id2, "adcdbeef", 7, controller_bus2, upstream_bus, controller_slot2
-    )
+    try:
+        stat = path.stat()
+        if stat.st_size == size and (not preallocate or stat.st_blocks * 512 >= size):
+            return 0
+        log.info(f"Resizing {path} from {stat.st_size} to {size} bytes")
+    except FileNotFoundError:
+        log.info(f"Creating {path} ({size} bytes)")
+
+    try:
+        with open(path, "ab") as image:
+            if preallocate:
+                os.posix_fallocate(image.fileno(), 0, size)
+            os.ftruncate(image.fileno(), size)
+    except OSError as exc:
+        log.error(f"Failed provisioning {path}: {exc}")
+        return exc.errno or errno.EIO
 
-    # Nvme1n1 - Namespace with NVM command-set
-    drive3, qemu_nvme_dev3 = QemuNvme.generate_namespace(controller_id2, 1, lbads, nvme_img_root)
-    nvme += qemu_nvme_dev3
-    drives.append(drive3)
-
-    # Nvme2 - Controller dedicated to testing HUGEPAGES / Large MDTS
-    controller_id3 = "nvme2"
-    controller_bus3 = "pcie_downstream_port3"
-    controller_slot3 = 3
-    nvme += QemuNvme.generate_controller(
-        controller_id3, "beefcace", 0, controller_bus3, upstream_bus, controller_slot3
-    )
-
-    # Nvme2n1 - NVM namespace
-    drive4, qemu_nvme_dev4 = QemuNvme.generate_namespace(controller_id3, 1, lbads, nvme_img_root)
-    nvme += qemu_nvme_dev4
-    drives.append(drive4)
+    return 0
 
-    #
-    # Nvme4 - Controller with PI enabled
-    #
 
-    controller_id5 = "nvme4"
-    controller_bus5 = "pcie_downstream_port5"
-    controller_slot5 = 5
-    nvme += QemuNvme.generate_controller(
-        controller_id5, "feebdaed", 7, controller_bus5, upstream_bus, controller_slot5
-    )
+def provision_drives(drives, drive_size, preallocate):
+    """
+    Create missing backing-storage for the given drives, all at once
 
-    # Nvme4n1 - NVM namespace with PI type 1
-    drv_pi1, qemu_nvme_dev_pi1 = QemuNvme.generate_namespace(controller_id5, 1, lbads, nvme_img_root, {"ms": 8, "pi": 1})
-    nvme += qemu_nvme_dev_pi1
-    drives.append(drv_pi1)
+    Existing images of the right size are used as-is. Images are created
+    sparse (only blocks written by the guest take up space) unless
+    'preallocate' is set.
 
-    # Nvme4n2 - NVM namespace with PI type 2
-    drv_pi2, qemu_nvme_dev_pi2 = QemuNvme.generate_namespace(controller_id5, 2, lbads, nvme_img_root, {"ms": 8, "pi": 2})
-    nvme += qemu_nvme_dev_pi2
-    drives.append(drv_pi2)
+    @returns 0 on success, errno of the first failure otherwise
+    """
 
-    # Nvme4n3 - NVM namespace with PI type 3
-    drv_pi3, qemu_nvme_dev_pi3 = QemuNvme.generate_namespace(controller_id5, 3, lbads, nvme_img_root, {"ms": 8, "pi": 3})
-    nvme += qemu_nvme_dev_pi3
-    drives.append(drv_pi3)
+    size = parse_size(drive_size)
+    paths = [Path(drive["file"]) for drive in drives]
+    for directory in {path.parent for path in paths}:
+        directory.mkdir(parents=True, exist_ok=True)
 
-    return drives, nvme, drive_size
+    with ThreadPoolExecutor(max_workers=max(len(paths), 1)) as executor:
+        errs = list(executor.map(lambda path: provision_drive(path, size, preallocate), paths))
 
+    return next((err for err in errs if err), 0)
 
-def qemu_ftl_nvme_args(nvme_img_root):
-    """
-    Returns list of drive-args, a string of qemu-arguments and drive size for each namespace
 
-    @returns drives, args, drive_size
+def provision_overlays(cijoe, drives, drive_size, nvme_img_cache):
     """
+    Give every drive a fresh qcow2 overlay on a shared, zeroed base image
 
-    lbads = 12
-    drive_size = "20G"
+    The base is a sparse raw image in 'nvme_img_cache', created once per
+    drive size and never written to. Whatever the previous run wrote is
+    thrown away by replacing the overlays, which only hold the clusters the
+    guest wrote, so no image is reallocated between runs.
 
-    drives = []
-    nvme = []
-    nvme += ["-device", "pcie-root-port,id=pcie_root_port1,chassis=1,slot=1"]
-
-    upstream_bus = "pcie_upstream_port1"
-    nvme += ["-device", f"x3130-upstream,id={upstream_bus},bus=pcie_root_port1"]
-
-    #
-    # Nvme0 - Base device for FTL
-    #
-    controller_id1 = "nvme0"
-    controller_bus1 = "pcie_downstream_port1"
-    controller_slot1 = 1
-    nvme += QemuNvme.generate_controller(
-        controller_id1, "deadbeef", 0, controller_bus1, upstream_bus, controller_slot1
-    )
+    @returns 0 on success, errno of the first failure otherwise
+    """
 
-    # Nvme0n1 - NVM namespace
-    drive1, qemu_nvme_dev1 = QemuNvme.generate_namespace(controller_id1, 1, lbads, nvme_img_root)
-    nvme += qemu_nvme_dev1
-    drives.append(drive1)
-
-    #
-    # Nvme1 - Cache device for FTL
-    #
-    controller_id2 = "nvme1"
-    controller_bus2 = "pcie_downstream_port2"
-    controller_slot2 = 2
-    nvme += QemuNvme.generate_controller(
-        controller_id2, "deadbeee", 0, controller_bus2, upstream_bus, controller_slot2
-    )
+    base = nvme_img_cache / f"base-{drive_size}.img"
+    err = provision_drives([{"file": str(base)}], drive_size, False)
+    if err:
+        return err
 
-    # Nvme1n1 - NVM namespace
-    drive2, qemu_nvme_dev2 = QemuNvme.generate_namespace(controller_id2, 1, lbads, nvme_img_root, {"ms": 64})
-    nvme += qemu_nvme_dev2
-    drives.append(drive2)
+    for drive in drives:
+        overlay = Path(drive["file"])
+        overlay.parent.mkdir(parents=True, exist_ok=True)
+        overlay.unlink(missing_ok=True)
+        err, _ = qemu_img(cijoe, f"create -f qcow2 -F raw -b {base} {overlay} {drive_size}")
+        if err:
+            log.error(f"Failed creating overlay {overlay}: err({err})")
+            return err
 
-    return drives, nvme, drive_size
+    return 0
 
 
 def main(args, cijoe):
@@ -379,23 +526,39 @@ def main(args, cijoe):
     if not nvme_setup:
         nvme_setup = "default"
 
-    nvme_setups = {
-        "default": qemu_nvme_args,
-        "zns": qemu_zns_nvme_args,
-        "ftl": qemu_ftl_nvme_args
-    }
+    nvme_setups = {**NVME_TOPOLOGIES, **cijoe.getconf("qemu.nvme_topologies", {})}
+    if nvme_setup not in nvme_setups:
+        log.error(f"unknown nvme_setup({nvme_setup}), expected one of {sorted(nvme_setups)}")
+        return errno.EINVAL
+    topology = nvme_setups[nvme_setup]
 
     nvme_img_root = Path(args.nvme_img_root or guest.guest_path)
-
-    nvme_setup = nvme_setups[nvme_setup]
-    drives, nvme_args, drive_size = nvme_setup(nvme_img_root)
-
-    # Check that the backing-storage exists, create them if they do not
-    for drive in drives:
-        err, _ = cijoe.run_local(f"[ -f {drive['file']} ]")
+    img_format = "raw"
+    if args.nvme_img_cache:
+        img_format = "qcow2"
+    elif args.nvme_img_pool:
+        # Keep pooled images apart by drive size, so that setups using
+        # different sizes do not resize each other's images on every boot
+        nvme_img_root = Path(args.nvme_img_pool) / str(topology.get("drive_size"))
+
+    try:
+        drives, nvme_args = QemuNvme.compile_topology(topology, nvme_img_root, img_format)
+    except ValueError as exc:
+        log.error(f"invalid nvme_setup({nvme_setup}): {exc}")
+        return errno.EINVAL
+    drive_size = topology["drive_size"]
+
+    if args.nvme_img_cache:
+        err = provision_overlays(cijoe, drives, drive_size, Path(args.nvme_img_cache))
+        if err:
+            log.error(f"provision_overlays() : err({err})")
+            return err
+    else:
+        # Check that the backing-storage exists, create them if they do not
+        err = provision_drives(drives, drive_size, args.nvme_img_alloc == "full")
         if err:
-            guest.image_create(drive["file"], drive["format"], drive_size)
-        err, _ = cijoe.run_local(f"[ -f {drive['file']} ]")
+            log.error(f"provision_drives() : err({err})")
+            return err
 
     err = guest.start(extra_args=nvme_args)
     if err:
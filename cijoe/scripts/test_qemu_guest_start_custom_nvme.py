@@ -0,0 +1,184 @@
+"""Regression tests for qemu_guest_start_custom_nvme.py.
+
+Run from cijoe/scripts, with cijoe installed:
+    python3 -m unittest test_qemu_guest_start_custom_nvme
+"""
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from qemu_guest_start_custom_nvme import NVME_TOPOLOGIES, QemuNvme, provision_drives
+
+# Command lines the hand-written builders produced for /img before the
+# topologies became data, one option and its value per entry
+OLD_COMMAND_LINES = {
+    "default": [
+        "-device pcie-root-port,id=pcie_root_port1,chassis=1,slot=1",
+        "-device x3130-upstream,id=pcie_upstream_port1,bus=pcie_root_port1",
+        "-device xio3130-downstream,id=pcie_downstream_port1,bus=pcie_upstream_port1,chassis=2,slot=1",
+        "-device nvme,id=nvme0,serial=deadbeef,bus=pcie_downstream_port1,mdts=7,ioeventfd=on",
+        "-drive id=nvme0n1,file=/img/nvme0n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme0n1,drive=nvme0n1,bus=nvme0,nsid=1,logical_block_size=4096,physical_block_size=4096",
+        "-drive id=nvme0n2,file=/img/nvme0n2.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme0n2,drive=nvme0n2,bus=nvme0,nsid=2,logical_block_size=4096,physical_block_size=4096,"
+            "zoned=off",
+        "-device xio3130-downstream,id=pcie_downstream_port2,bus=pcie_upstream_port1,chassis=2,slot=2",
+        "-device nvme,id=nvme1,serial=adcdbeef,bus=pcie_downstream_port2,mdts=7,ioeventfd=on",
+        "-drive id=nvme1n1,file=/img/nvme1n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme1n1,drive=nvme1n1,bus=nvme1,nsid=1,logical_block_size=4096,physical_block_size=4096",
+        "-device xio3130-downstream,id=pcie_downstream_port3,bus=pcie_upstream_port1,chassis=2,slot=3",
+        "-device nvme,id=nvme2,serial=beefcace,bus=pcie_downstream_port3,mdts=0,ioeventfd=on",
+        "-drive id=nvme2n1,file=/img/nvme2n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme2n1,drive=nvme2n1,bus=nvme2,nsid=1,logical_block_size=4096,physical_block_size=4096",
+        "-device xio3130-downstream,id=pcie_downstream_port5,bus=pcie_upstream_port1,chassis=2,slot=5",
+        "-device nvme,id=nvme4,serial=feebdaed,bus=pcie_downstream_port5,mdts=7,ioeventfd=on",
+        "-drive id=nvme4n1,file=/img/nvme4n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme4n1,drive=nvme4n1,bus=nvme4,nsid=1,logical_block_size=4096,physical_block_size=4096,"
+            "ms=8,pi=1",
+        "-drive id=nvme4n2,file=/img/nvme4n2.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme4n2,drive=nvme4n2,bus=nvme4,nsid=2,logical_block_size=4096,physical_block_size=4096,"
+            "ms=8,pi=2",
+        "-drive id=nvme4n3,file=/img/nvme4n3.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme4n3,drive=nvme4n3,bus=nvme4,nsid=3,logical_block_size=4096,physical_block_size=4096,"
+            "ms=8,pi=3",
+    ],
+    "zns": [
+        "-device pcie-root-port,id=pcie_root_port1,chassis=1,slot=1",
+        "-device x3130-upstream,id=pcie_upstream_port1,bus=pcie_root_port1",
+        "-device xio3130-downstream,id=pcie_downstream_port1,bus=pcie_upstream_port1,chassis=2,slot=1",
+        "-device nvme,id=nvme0,serial=deadbeef,bus=pcie_downstream_port1,mdts=7,ioeventfd=on",
+        "-drive id=nvme0n1,file=/img/nvme0n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme0n1,drive=nvme0n1,bus=nvme0,nsid=1,logical_block_size=4096,physical_block_size=4096",
+        "-drive id=nvme0n2,file=/img/nvme0n2.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme0n2,drive=nvme0n2,bus=nvme0,nsid=2,logical_block_size=4096,physical_block_size=4096,"
+            "zoned=on,zoned.zone_size=32M,zoned.zone_capacity=28M,zoned.max_active=256,zoned.max_open=256,"
+            "zoned.zrwas=131072,zoned.zrwafg=65536,zoned.numzrwa=256",
+        "-device xio3130-downstream,id=pcie_downstream_port2,bus=pcie_upstream_port1,chassis=2,slot=2",
+        "-device nvme,id=nvme1,serial=adcdbeef,bus=pcie_downstream_port2,mdts=7,ioeventfd=on",
+        "-drive id=nvme1n1,file=/img/nvme1n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme1n1,drive=nvme1n1,bus=nvme1,nsid=1,logical_block_size=4096,physical_block_size=4096",
+        "-device xio3130-downstream,id=pcie_downstream_port3,bus=pcie_upstream_port1,chassis=2,slot=3",
+        "-device nvme,id=nvme2,serial=beefcace,bus=pcie_downstream_port3,mdts=0,ioeventfd=on",
+        "-drive id=nvme2n1,file=/img/nvme2n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme2n1,drive=nvme2n1,bus=nvme2,nsid=1,logical_block_size=4096,physical_block_size=4096",
+        "-device xio3130-downstream,id=pcie_downstream_port5,bus=pcie_upstream_port1,chassis=2,slot=5",
+        "-device nvme,id=nvme4,serial=feebdaed,bus=pcie_downstream_port5,mdts=7,ioeventfd=on",
+        "-drive id=nvme4n1,file=/img/nvme4n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme4n1,drive=nvme4n1,bus=nvme4,nsid=1,logical_block_size=4096,physical_block_size=4096,"
+            "ms=8,pi=1",
+        "-drive id=nvme4n2,file=/img/nvme4n2.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme4n2,drive=nvme4n2,bus=nvme4,nsid=2,logical_block_size=4096,physical_block_size=4096,"
+            "ms=8,pi=2",
+        "-drive id=nvme4n3,file=/img/nvme4n3.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme4n3,drive=nvme4n3,bus=nvme4,nsid=3,logical_block_size=4096,physical_block_size=4096,"
+            "ms=8,pi=3",
+    ],
+    "ftl": [
+        "-device pcie-root-port,id=pcie_root_port1,chassis=1,slot=1",
+        "-device x3130-upstream,id=pcie_upstream_port1,bus=pcie_root_port1",
+        "-device xio3130-downstream,id=pcie_downstream_port1,bus=pcie_upstream_port1,chassis=2,slot=1",
+        "-device nvme,id=nvme0,serial=deadbeef,bus=pcie_downstream_port1,mdts=0,ioeventfd=on",
+        "-drive id=nvme0n1,file=/img/nvme0n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme0n1,drive=nvme0n1,bus=nvme0,nsid=1,logical_block_size=4096,physical_block_size=4096",
+        "-device xio3130-downstream,id=pcie_downstream_port2,bus=pcie_upstream_port1,chassis=2,slot=2",
+        "-device nvme,id=nvme1,serial=deadbeee,bus=pcie_downstream_port2,mdts=0,ioeventfd=on",
+        "-drive id=nvme1n1,file=/img/nvme1n1.img,format=raw,if=none,discard=on,detect-zeroes=unmap",
+        "-device nvme-ns,id=nvme1n1,drive=nvme1n1,bus=nvme1,nsid=1,logical_block_size=4096,physical_block_size=4096,"
+            "ms=64",
+    ],
+}
+
+
+def _topology(**namespace):
+    return {"drive_size": "1G", "controllers": [{"namespaces": [{"nsid": 1, **namespace}]}]}
+
+
+class TopologyTest(unittest.TestCase):
+    def test_compiles_old_command_lines(self):
+        for setup, expected in OLD_COMMAND_LINES.items():
+            drives, args = QemuNvme.compile_topology(NVME_TOPOLOGIES[setup], "/img")
+            self.assertEqual([f"{option} {value}" for option, value in zip(args[::2], args[1::2])], expected, setup)
+            self.assertEqual([drive["file"] for drive in drives],
+                             [line.split(",")[1].removeprefix("file=") for line in expected
+                              if line.startswith("-drive")], setup)
+
+    def test_rejects_mistyped_values(self):
+        topologies = [
+            _topology(ms="8", pi=1),
+            _topology(ms=True),
+            _topology(lbads="12"),
+            _topology(pi=4, ms=8),
+            {**_topology(), "lbads": 12.0},
+            {**_topology(), "controller": {"max_ioqpairs": "8"}},
+            {**_topology(), "controller": {"mdts": None}},
+            {**_topology(), "controllers": [{"id": ["nvme0"], "namespaces": [{"nsid": 1}]}]},
+            {**_topology(), "controllers": [{"namespaces": "nvme0n1"}]},
+            {**_topology(), "controllers": "nvme0"},
+            {**_topology(), "drive_size": ""},
+        ]
+        for topology in topologies:
+            with self.assertRaises(ValueError, msg=topology):
+                QemuNvme.compile_topology(topology, "/img")
+
+
+class ProvisionDrivesTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+
+    def drives(self, nvme_img_root):
+        drives, _ = QemuNvme.compile_topology(NVME_TOPOLOGIES["ftl"], nvme_img_root)
+        return drives
+
+    def test_creates_missing_images(self):
+        drives = self.drives(self.root / "guest")
+        self.assertEqual(provision_drives(drives, "4M", False), 0)
+
+        for drive in drives:
+            stat = os.stat(drive["file"])
+            self.assertEqual(stat.st_size, 4 << 20)
+            # Sparse: nothing is allocated until the guest writes
+            self.assertLess(stat.st_blocks * 512, 4 << 20)
+
+    def test_preallocates_images(self):
+        drives = self.drives(self.root / "guest")
+        self.assertEqual(provision_drives(drives, "4M", True), 0)
+
+        for drive in drives:
+            self.assertGreaterEqual(os.stat(drive["file"]).st_blocks * 512, 4 << 20)
+
+    def test_resizes_images_of_another_size(self):
+        drives = self.drives(self.root / "guest")
+        provision_drives(drives, "8M", False)
+
+        self.assertEqual(provision_drives(drives, "4M", False), 0)
+        for drive in drives:
+            self.assertEqual(os.stat(drive["file"]).st_size, 4 << 20)
+
+    def test_reuses_pooled_images(self):
+        # main() keeps pooled images in a directory per drive size
+        drives = self.drives(self.root / "pool" / "4M")
+        provision_drives(drives, "4M", False)
+        with open(drives[0]["file"], "r+b") as image:
+            image.write(b"written by the previous boot")
+        inodes = [os.stat(drive["file"]).st_ino for drive in drives]
+
+        self.assertEqual(provision_drives(self.drives(self.root / "pool" / "4M"), "4M", False), 0)
+
+        self.assertEqual([os.stat(drive["file"]).st_ino for drive in drives], inodes)
+        with open(drives[0]["file"], "rb") as image:
+            self.assertEqual(image.read(28), b"written by the previous boot")
+
+    def test_reports_errno_of_failure(self):
+        drives = self.drives(self.root / "guest")
+        Path(drives[0]["file"]).parent.mkdir()
+        Path(drives[0]["file"]).mkdir()
+
+        self.assertNotEqual(provision_drives(drives, "4M", False), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,862 @@
+#!/usr/bin/env python3
+"""Offline load test for the forwarder and mergable_changes.
+
+Starts local stand-ins for the GitHub Actions API (repository dispatches and
+workflow run listings) and the Gerrit REST API, runs the service under test
+in a child process pointed at them, and prints a JSON report.  Nothing
+talks to api.github.com or review.spdk.io.
+
+Scenarios:
+
+  forwarder         Replays a webhook storm generated from the
+                    .github/example_events fixtures and measures ingestion
+                    throughput, dispatch latency, API calls and memory.
+  mergable_changes  Polls a synthetic set of ready change series while the
+                    stub Gerrit keeps updating some of them, and measures
+                    the time per poll, API calls and memory.
+
+With --baseline, the report also compares every number against an earlier
+report, so scheduler and caching changes can be measured before merging.
+"""
+
+import argparse
+import copy
+import datetime
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+INFRA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_DIR = os.path.join(INFRA_DIR, "common")
+FORWARDER_DIR = os.path.join(INFRA_DIR, "forwarder")
+MERGABLE_CHANGES_DIR = os.path.join(INFRA_DIR, "mergable_changes")
+EXAMPLE_EVENTS_DIR = os.path.join(os.path.dirname(INFRA_DIR), ".github", "example_events")
+
+GITHUB_REPO = "spdk/spdk-ci"
+WORKFLOW_FILE = "gerrit-webhook-handler.yml"
+WORKFLOW_RUNS_PATH = f"/repos/{GITHUB_REPO}/actions/workflows/{WORKFLOW_FILE}/runs"
+DISPATCHES_PATH = f"/repos/{GITHUB_REPO}/dispatches"
+RUNNERS_PATH = f"/repos/{GITHUB_REPO}/actions/runners"
+# Route and secret of the forwarder's workflow_run webhook
+GITHUB_WEBHOOK_PATH = "/github/workflow_run"
+GITHUB_WEBHOOK_SECRET = "benchmark"
+# Seconds from a dispatch to the in_progress webhook of its run
+WEBHOOK_DELAY = 0.2
+# shr_<category> runners each simulated run takes while it lasts: the two
+# shr_generic_rank entries of spdk-common-tests.yml and the nvmf-rdma job
+WORKFLOW_RUNNERS = {"generic": 2, "rdma": 1}
+# Prefix Gerrit puts in front of every JSON response
+GERRIT_MAGIC_PREFIX = ")]}'\n"
+GERRIT_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+# Synthetic change numbers start here, clear of the fixtures' 17495
+FIRST_CHANGE = 100000
+# Seconds allowed for a child process to start serving or exit
+CHILD_TIMEOUT = 30
+
+
+def percentiles(values):
+    """Summarize latencies as nearest-rank percentiles, in seconds."""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return round(values[max(0, -(-len(values) * p // 100) - 1)], 6)
+
+    return {
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": round(values[-1], 6),
+        "mean": round(sum(values) / len(values), 6),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Base for the stub API handlers; keeps connections alive and logs nothing."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, document, headers=None, prefix=""):
+        body = (prefix + json.dumps(document)).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+
+def start_stub(handler_class, state):
+    """Serve handler_class on an ephemeral local port; returns (server, base URL)."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class GitHubState:
+    """Workflow runs created by repository dispatches, each running for run_seconds.
+
+    runner_pool maps a category to its number of self-hosted runners.  A
+    run takes WORKFLOW_RUNNERS of those that are idle when it starts.
+    Without a pool the runners API answers 404, as it does for a token
+    that cannot list runners.
+
+    After send_webhooks(), every run is also reported to the forwarder
+    through signed workflow_run webhooks when it starts and completes.
+    """
+
+    def __init__(self, run_seconds, runner_pool=None):
+        self.run_seconds = run_seconds
+        self.runner_pool = runner_pool
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.webhook_url = None
+        # heap of (due, run id, status) webhooks to deliver
+        self.webhooks = []
+        self.webhooks_due = threading.Condition(self.lock)
+        self.webhooks_sent = Counter()
+        # id -> run, in the shape of the workflow runs API
+        self.runs = {}
+        self.next_run_id = 1
+        # (time, event_type, change number, patchset number) per dispatch
+        self.dispatches = []
+
+    def dispatch(self, body):
+        now = time.time()
+        event_type = body.get("event_type")
+        payload = body.get("client_payload", {})
+        change = payload.get("change", {})
+        patchset = payload.get("patchSet", {})
+        with self.lock:
+            self.dispatches.append((now, event_type, change.get("number"), patchset.get("number")))
+            # Forwarded comments start other workflows, not the handler
+            # whose active runs the forwarder throttles on.
+            if event_type == "comment-added":
+                return
+            run_id = self.next_run_id
+            self.next_run_id += 1
+            busy = self._busy_runners(now)
+            self.runs[run_id] = {
+                "id": run_id,
+                "status": "in_progress",
+                "display_title": f"({change.get('number')}/{patchset.get('number')}){change.get('subject', '')}",
+                "html_url": f"https://github.com/{GITHUB_REPO}/actions/runs/{run_id}",
+                "finishes": now + self.run_seconds,
+                "runners": {category: min(count, (self.runner_pool or {}).get(category, 0) - busy[category])
+                            for category, count in WORKFLOW_RUNNERS.items()},
+            }
+            if self.webhook_url:
+                heapq.heappush(self.webhooks, (now + WEBHOOK_DELAY, run_id, "in_progress"))
+                heapq.heappush(self.webhooks, (now + self.run_seconds, run_id, "completed"))
+                self.webhooks_due.notify()
+
+    def send_webhooks(self, url):
+        """Deliver workflow_run webhooks for the runs to url from now on."""
+        self.webhook_url = url
+        threading.Thread(target=self._deliver_webhooks, args=(url,), daemon=True).start()
+
+    def stop_webhooks(self):
+        """Drop the webhooks not delivered yet, before the forwarder stops."""
+        with self.lock:
+            self.webhook_url = None
+            self.webhooks.clear()
+            self.webhooks_due.notify()
+
+    def _deliver_webhooks(self, url):
+        while True:
+            with self.lock:
+                while self.webhook_url and (not self.webhooks or self.webhooks[0][0] > time.time()):
+                    self.webhooks_due.wait(self.webhooks[0][0] - time.time() if self.webhooks else None)
+                if not self.webhook_url:
+                    return
+                _, run_id, status = heapq.heappop(self.webhooks)
+                run = {k: v for k, v in self.runs[run_id].items() if k not in ("finishes", "runners")}
+            run.update(status=status, path=f".github/workflows/{WORKFLOW_FILE}")
+            body = json.dumps({
+                "action": status,
+                "workflow_run": run,
+                "repository": {"full_name": GITHUB_REPO},
+            }).encode("utf-8")
+            signature = "sha256=" + hmac.new(GITHUB_WEBHOOK_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+            request = urllib.request.Request(url, data=body, headers={
+                "Content-Type": "application/json",
+                "X-GitHub-Event": "workflow_run",
+                "X-Hub-Signature-256": signature,
+            })
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                self.webhooks_sent[status] += 1
+            except OSError as exc:
+                logging.warning(f"Failed to deliver the {status} webhook of run {run_id}: {exc}")
+
+    def _busy_runners(self, now):
+        busy = Counter()
+        for run in self.runs.values():
+            if run["finishes"] > now:
+                busy.update(run["runners"])
+        return busy
+
+    def list_runners(self):
+        """Return the runners in the shape of the runners API, or None without a pool."""
+        if self.runner_pool is None:
+            return None
+        with self.lock:
+            busy = self._busy_runners(time.time())
+        return [
+            {
+                "id": len(self.runner_pool) * i + index,
+                "name": f"shr-{category}-{i}",
+                "status": "online",
+                "busy": i < busy[category],
+                "labels": [{"name": "self-hosted"}, {"name": f"shr_{category}"}],
+            }
+            for index, (category, count) in enumerate(self.runner_pool.items())
+            for i in range(count)
+        ]
+
+    def list_runs(self, status):
+        now = time.time()
+        with self.lock:
+            return [{k: v for k, v in run.items() if k not in ("finishes", "runners")}
+                    for run in self.runs.values() if run["status"] == status and run["finishes"] > now]
+
+
+class GitHubHandler(StubHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == RUNNERS_PATH:
+            self.send_runners()
+            return
+        if url.path != WORKFLOW_RUNS_PATH:
+            self.send_empty(404)
+            return
+
+        query = parse_qs(url.query)
+        status = query.get("status", [""])[0]
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        runs = self.server.state.list_runs(status)
+        page_runs = runs[(page - 1) * per_page:page * per_page]
+        # Like GitHub's, the ETag covers just this page of the listing
+        digest = hashlib.sha1(repr((status, len(runs), [run["id"] for run in page_runs])).encode())
+        etag = f'"{digest.hexdigest()}"'
+        if etag == self.headers.get("If-None-Match"):
+            self.server.state.calls["GET workflow_runs 304"] += 1
+            self.send_empty(304, {"ETag": etag})
+            return
+
+        headers = {"ETag": etag}
+        if page * per_page < len(runs):
+            host = self.headers.get("Host")
+            next_query = urlencode({"status": status, "per_page": per_page, "page": page + 1})
+            headers["Link"] = f'<http://{host}{url.path}?{next_query}>; rel="next"'
+        self.server.state.calls["GET workflow_runs 200"] += 1
+        self.send_json(200, {
+            "total_count": len(runs),
+            "workflow_runs": page_runs,
+        }, headers)
+
+    def send_runners(self):
+        runners = self.server.state.list_runners()
+        if runners is None:
+            self.server.state.calls["GET runners 404"] += 1
+            self.send_empty(404)
+            return
+        etag = '"' + hashlib.sha1(repr(runners).encode()).hexdigest() + '"'
+        if etag == self.headers.get("If-None-Match"):
+            self.server.state.calls["GET runners 304"] += 1
+            self.send_empty(304, {"ETag": etag})
+            return
+        self.server.state.calls["GET runners 200"] += 1
+        self.send_json(200, {"total_count": len(runners), "runners": runners}, {"ETag": etag})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if urlparse(self.path).path != DISPATCHES_PATH:
+            self.send_empty(404)
+            return
+        self.server.state.dispatch(body)
+        self.server.state.calls["POST dispatches 204"] += 1
+        self.send_empty(204)
+
+
+class GerritState:
+    """Open changes stacked in series, a few of which are updated every second."""
+
+    def __init__(self, changes=0, series_length=1, churn=0, seed=0):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.churn = churn
+        self.rng = random.Random(seed)
+        # change number -> change JSON, as returned for the mergable_changes
+        # query options
+        self.changes = {}
+        # change number -> the numbers of its series, oldest first
+        self.series = {}
+        # change number -> epoch of the last update
+        self.updated = {}
+
+        now = time.time()
+        owners = [f"owner{i:03d}" for i in range(max(changes // 10, 1))]
+        parent_revision = None
+        series = []
+        for i in range(changes):
+            number = FIRST_CHANGE + i
+            if i % series_length == 0:
+                parent_revision, series = f"{self.rng.getrandbits(160):040x}", []
+            series.append(number)
+            revision = f"{self.rng.getrandbits(160):040x}"
+            created = now - self.rng.uniform(3600, 30 * 86400)
+            self.changes[number] = self._change_json(number, self.rng.choice(owners), revision, parent_revision,
+                                                     created)
+            self.series[number] = list(series)
+            self.updated[number] = created
+            parent_revision = revision
+
+    def _change_json(self, number, owner, revision, parent_revision, created):
+        # Mostly ready changes, with the odd conflict, -1 or missing +2 so
+        # every status page section has entries.
+        reviews = [{"value": 2, "name": "Core Maintainer"}]
+        roll = self.rng.random()
+        if roll < 0.1:
+            reviews.append({"value": -1, "name": "Reviewer"})
+        elif roll < 0.2:
+            reviews = [{"value": 1, "name": "Reviewer"}]
+        mergeable = self.rng.random() >= 0.05
+        created_on = datetime.datetime.fromtimestamp(created, datetime.timezone.utc)
+        return {
+            "_number": number,
+            "project": "spdk/spdk",
+            "branch": "master",
+            "status": "NEW",
+            "subject": f"Synthetic change {number}",
+            "owner": {"name": owner, "username": owner},
+            "mergeable": mergeable,
+            "submittable": mergeable and roll >= 0.2,
+            "labels": {"Code-Review": {"all": reviews}, "Verified": {"all": [{"value": 1, "name": "CI"}]}},
+            "current_revision": revision,
+            "revisions": {
+                revision: {
+                    "_number": 1,
+                    "ref": f"refs/changes/{number % 100:02d}/{number}/1",
+                    "created": created_on.strftime(GERRIT_TIMESTAMP_FORMAT) + "000",
+                    "commit": {"parents": [{"commit": parent_revision}]},
+                },
+            },
+        }
+
+    def run_churn(self):
+        """Update churn random changes every second, forever."""
+        while self.changes and self.churn:
+            time.sleep(1)
+            with self.lock:
+                now = time.time()
+                for number in self.rng.sample(sorted(self.changes), min(self.churn, len(self.changes))):
+                    self.updated[number] = now
+
+    def query(self, query):
+        """Return (kind, changes) for a search; label predicates are not evaluated."""
+        with self.lock:
+            if match := re.search(r'after:"([^"]+)"', query):
+                after = datetime.datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+                after = after.replace(tzinfo=datetime.timezone.utc).timestamp()
+                return "after", [self.changes[n] for n, updated in self.updated.items() if updated > after]
+            if numbers := re.findall(r"change:(\d+)", query):
+                return "change", [self.changes[int(n)] for n in numbers if int(n) in self.changes]
+            return "full", list(self.changes.values())
+
+    def submitted_together(self, number):
+        with self.lock:
+            series = self.series.get(number)
+            if series is None:
+                return None
+            # Newest first, up to and including the change itself
+            return [self.changes[n] for n in reversed(series[:series.index(number) + 1])]
+
+
+class GerritHandler(StubHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        state = self.server.state
+        if url.path == "/changes/":
+            query = parse_qs(url.query)
+            kind, changes = state.query(query.get("q", [""])[0])
+            start = int(query.get("S", ["0"])[0])
+            limit = int(query.get("n", ["500"])[0])
+            page = [dict(change) for change in changes[start:start + limit]]
+            if page and start + limit < len(changes):
+                page[-1]["_more_changes"] = True
+            state.calls[f"GET changes {kind}"] += 1
+            self.send_json(200, page, prefix=GERRIT_MAGIC_PREFIX)
+        elif match := re.fullmatch(r"/changes/(\d+)/submitted_together", url.path):
+            series = state.submitted_together(int(match.group(1)))
+            state.calls["GET submitted_together"] += 1
+            if series is None:
+                self.send_empty(404)
+            else:
+                self.send_json(200, series, prefix=GERRIT_MAGIC_PREFIX)
+        else:
+            self.send_empty(404)
+
+
+def start_child(scenario, child_args, env, cwd, log):
+    """Run this script as the service under test in a child process.
+
+    The service's log and access log go to the file log, or are discarded.
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([COMMON_DIR, cwd]), "LOG_LEVEL": "WARNING", **env}
+    with open(log or os.devnull, "a") as stderr:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", scenario, *child_args],
+                                cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+                                text=True)
+
+
+def finish_child(child, timeout=CHILD_TIMEOUT):
+    """Close the child's stdin, which tells it to exit, and return its JSON result."""
+    stdout, _ = child.communicate(input="", timeout=timeout)
+    if child.returncode != 0:
+        raise RuntimeError(f"{child.args} exited with {child.returncode}")
+    return json.loads(stdout.strip().splitlines()[-1])
+
+
+def wait_for_port(port, child):
+    deadline = time.monotonic() + CHILD_TIMEOUT
+    while time.monotonic() < deadline:
+        if child.poll() is not None:
+            raise RuntimeError(f"{child.args} exited with {child.returncode} during startup")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port} after {CHILD_TIMEOUT}s")
+
+
+def build_storm(args, rng):
+    """Return the webhook payloads of a storm, grouped per change.
+
+    Payloads are copies of the example events with the change, patchset and
+    owner rewritten.  A few owners upload most of the patchsets, as on the
+    real instance.  Each change's events keep their order when replayed.
+    """
+    templates = {}
+    for event_type in ("patchset-created", "comment-added"):
+        with open(os.path.join(EXAMPLE_EVENTS_DIR, f"{event_type}.json")) as f:
+            templates[event_type] = json.load(f)["client_payload"]
+
+    owners = [f"owner{i:03d}" for i in range(args.owners)]
+    # Zipf-like: the n-th owner uploads about 1/n as much as the first
+    owner_weights = [1 / (i + 1) for i in range(args.owners)]
+    change_owner = {}
+    patchsets = defaultdict(int)
+    events = defaultdict(list)
+    now = int(time.time())
+
+    for _ in range(args.events):
+        if patchsets and rng.random() < args.comment_ratio:
+            number = rng.choice(list(patchsets))
+            payload = copy.deepcopy(templates["comment-added"])
+            if rng.random() < args.false_positive_ratio:
+                payload["comment"] = f"Patch Set {patchsets[number]}:\n\nfalse positive: #{rng.randrange(1, 4000)}"
+            else:
+                payload["comment"] = f"Patch Set {patchsets[number]}:\n\nLooks good"
+        else:
+            number = FIRST_CHANGE + rng.randrange(args.changes)
+            patchsets[number] += 1
+            payload = copy.deepcopy(templates["patchset-created"])
+            if number not in change_owner:
+                change_owner[number] = rng.choices(owners, owner_weights)[0]
+
+        owner = change_owner[number]
+        patchset = patchsets[number]
+        payload["change"].update({
+            "number": number,
+            "subject": f"Synthetic change {number}",
+            "url": f"https://review.spdk.io/c/spdk/spdk/+/{number}",
+            "owner": {"name": owner, "email": f"{owner}@example.com", "username": owner},
+        })
+        payload["patchSet"].update({
+            "number": patchset,
+            "revision": f"{rng.getrandbits(160):040x}",
+            "ref": f"refs/changes/{number % 100:02d}/{number}/{patchset}",
+            "createdOn": now,
+        })
+        payload["eventCreatedOn"] = now
+        events[number].append(payload)
+    return events
+
+
+def replay_storm(url, events, concurrency, rate=None):
+    """POST the storm to the forwarder from concurrency senders.
+
+    Each change is sent by one sender, so its events arrive in order.  With
+    a rate, the senders together send about rate webhooks per second
+    instead of as fast as the forwarder accepts them.  Every webhook is
+    sent once: a delivery that fails to connect, is cut off or gets an
+    error status is counted as failed, not retried, so the report shows
+    what the forwarder drops.  Returns (delivered, response latencies,
+    failures), where delivered lists (time sent, payload) of the accepted
+    webhooks and failures counts the failed ones by error.
+    """
+    lanes = [[] for _ in range(concurrency)]
+    for number, payloads in events.items():
+        lanes[number % concurrency].extend(payloads)
+    delivered = []
+    latencies = []
+    failures = Counter()
+    lock = threading.Lock()
+    replay_started = time.time()
+
+    def send_lane(lane):
+        # Senders take turns, so paced webhooks arrive evenly, not in bursts
+        for index, payload in enumerate(lanes[lane]):
+            if rate:
+                time.sleep(max(replay_started + (index * concurrency + lane) / rate - time.time(), 0))
+            data = json.dumps(payload).encode("utf-8")
+            started = time.time()
+            request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+            except urllib.error.HTTPError as exc:
+                with lock:
+                    failures[f"HTTP {exc.code}"] += 1
+                continue
+            except OSError as exc:
+                with lock:
+                    failures[type(getattr(exc, "reason", exc)).__name__] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - started)
+                delivered.append((started, payload))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for result in executor.map(send_lane, range(concurrency)):
+            pass
+    return delivered, latencies, failures
+
+
+def benchmark_forwarder(args):
+    rng = random.Random(args.seed)
+    events = build_storm(args, rng)
+
+    github = GitHubState(args.run_seconds, dict(args.runner_pool) if args.runner_pool else None)
+    gerrit = GerritState()
+    github_server, github_url = start_stub(GitHubHandler, github)
+    gerrit_server, gerrit_url = start_stub(GerritHandler, gerrit)
+
+    with tempfile.TemporaryDirectory(prefix="forwarder-benchmark-") as workdir:
+        port = free_port()
+        env = {
+            "FORWARDER_GITHUB_TOKEN": "benchmark",
+            "FORWARDER_GITHUB_API_URL": github_url,
+            "FORWARDER_GITHUB_REPO": GITHUB_REPO,
+            "FORWARDER_MAX_RUNNING_WORKFLOWS": str(args.max_workflows),
+            "FORWARDER_WORKFLOW_RUNS_CACHE_TTL": str(args.cache_ttl),
+            "FORWARDER_QUEUE_PROCESS_INTERVAL": str(args.queue_interval),
+            "FORWARDER_STATE_DIR": os.path.join(workdir, "state"),
+            "OUTPUT_DIR": workdir,
+            "GERRIT_URL": gerrit_url,
+            "CHANGE_EVENT_SOCKET": "",
+            "FORWARDER_GITHUB_WEBHOOK_SECRET": GITHUB_WEBHOOK_SECRET if args.github_webhooks else "",
+            **dict(args.env),
+        }
+        child = start_child("forwarder", [str(port)], env, FORWARDER_DIR, args.service_log)
+        try:
+            wait_for_port(port, child)
+            if args.github_webhooks:
+                github.send_webhooks(f"http://127.0.0.1:{port}{GITHUB_WEBHOOK_PATH}")
+            total = sum(len(payloads) for payloads in events.values())
+            logging.info(f"Replaying {total} events for {len(events)} changes from {args.owners} owners")
+            started = time.time()
+            delivered, response_latencies, failures = replay_storm(f"http://127.0.0.1:{port}/", events,
+                                                                   args.concurrency, args.rate)
+            ingest_seconds = time.time() - started
+
+            # The newest delivered patchset of every change must be dispatched
+            # eventually; older ones may be replaced in the queue before their
+            # turn.  Undelivered webhooks are reported as failures instead.
+            sent = {(p["change"]["number"], p["patchSet"]["number"]): sent_at
+                    for sent_at, p in delivered if p["type"] == "patchset-created"}
+            newest = {}
+            for change, patchset in sent:
+                newest[change] = max(newest.get(change, 0), patchset)
+            final_patchsets = set(newest.items())
+            forwards = sum(1 for _, p in delivered if p["type"] == "comment-added" and "false positive" in p["comment"])
+
+            dispatched, forwarded = set(), 0
+            deadline = time.monotonic() + args.timeout
+            while time.monotonic() < deadline:
+                with github.lock:
+                    dispatched = {(change, patchset) for _, event_type, change, patchset in github.dispatches
+                                  if event_type == "patchset-created"}
+                    forwarded = sum(1 for _, event_type, _, _ in github.dispatches if event_type == "comment-added")
+                if final_patchsets <= dispatched and forwarded >= forwards:
+                    break
+                time.sleep(0.2)
+            else:
+                logging.warning(f"Timed out after {args.timeout}s with {len(final_patchsets - dispatched)}"
+                                f" patchsets not dispatched")
+            github.stop_webhooks()
+            child_result = finish_child(child)
+        finally:
+            if child.poll() is None:
+                child.kill()
+            github_server.shutdown()
+            gerrit_server.shutdown()
+
+    dispatch_latencies = []
+    last_dispatch = started
+    with github.lock:
+        for dispatched_at, event_type, change, patchset in github.dispatches:
+            if event_type == "patchset-created" and (change, patchset) in sent:
+                dispatch_latencies.append(dispatched_at - sent[(change, patchset)])
+            last_dispatch = max(last_dispatch, dispatched_at)
+
+    return {
+        "ingest": {
+            "events": total,
+            "seconds": round(ingest_seconds, 3),
+            "events_per_second": round(total / ingest_seconds, 1),
+            "failed": sum(failures.values()),
+            "failures": dict(failures),
+            "response_seconds": percentiles(response_latencies),
+        },
+        "dispatch": {
+            "patchsets": len(sent),
+            "dispatched": len(dispatched),
+            "superseded": len(sent.keys() - dispatched - final_patchsets),
+            "undispatched": len(final_patchsets - dispatched),
+            "forwarded": forwarded,
+            "drain_seconds": round(last_dispatch - started, 3),
+            "latency_seconds": percentiles(dispatch_latencies),
+        },
+        "api_calls": {"github": dict(github.calls), "gerrit": dict(gerrit.calls)},
+        "github_webhooks": dict(github.webhooks_sent),
+        "memory": child_result,
+    }
+
+
+def benchmark_mergable_changes(args):
+    gerrit = GerritState(args.changes, args.series_length, args.churn, args.seed)
+    threading.Thread(target=gerrit.run_churn, daemon=True).start()
+    gerrit_server, gerrit_url = start_stub(GerritHandler, gerrit)
+
+    with tempfile.TemporaryDirectory(prefix="mergable-changes-benchmark-") as workdir:
+        env = {"GERRIT_URL": gerrit_url, "OUTPUT_DIR": workdir, "CHANGE_EVENT_SOCKET": "", **dict(args.env)}
+        child = start_child("mergable_changes", [str(args.passes), str(args.interval)], env,
+                            MERGABLE_CHANGES_DIR, args.service_log)
+        try:
+            logging.info(f"Polling {args.changes} changes {args.passes} times")
+            child_result = finish_child(child, timeout=CHILD_TIMEOUT + args.passes * (args.interval + 60))
+        finally:
+            if child.poll() is None:
+                child.kill()
+            gerrit_server.shutdown()
+
+    passes = child_result.pop("passes")
+    return {
+        "poll": {
+            "first_seconds": round(passes[0], 6),
+            "incremental_seconds": percentiles(passes[1:]),
+        },
+        "api_calls": {"gerrit": dict(gerrit.calls)},
+        "memory": child_result,
+    }
+
+
+def child_memory():
+    # ru_maxrss is in KiB on Linux
+    return {"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_forwarder_child(port):
+    import forwarder
+
+    logging.basicConfig(level=forwarder.config.log_level, format="%(asctime)s - %(levelname)s - %(message)s")
+    threading.Thread(target=forwarder.serve, args=(int(port),), daemon=True).start()
+    sys.stdin.read()
+    print(json.dumps(child_memory()))
+
+
+def run_mergable_changes_child(passes, interval):
+    import mergable_changes
+
+    config = mergable_changes.config
+    logging.basicConfig(level=config.log_level, format="%(asctime)s - %(levelname)s - %(message)s")
+    gerrit = mergable_changes.gerrit_client.connect(config.gerrit_url, pool_size=config.series_fetch_workers)
+    cache = mergable_changes.ChangeCache()
+    timings = []
+    for i in range(int(passes)):
+        if i:
+            time.sleep(float(interval))
+        started = time.monotonic()
+        cache.refresh(gerrit)
+        mergable_changes.publish_status(gerrit, cache)
+        timings.append(time.monotonic() - started)
+    sys.stdin.read()
+    print(json.dumps({"passes": timings, **child_memory()}))
+
+
+def flatten(document, prefix=""):
+    """Map dotted paths to the numbers in a nested report."""
+    numbers = {}
+    for key, value in (document or {}).items():
+        if isinstance(value, dict):
+            numbers.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            numbers[f"{prefix}{key}"] = value
+    return numbers
+
+
+def compare(results, baseline):
+    """Return {path: {baseline, current, change}} for the numbers in both reports."""
+    current, previous = flatten(results), flatten(baseline.get("results"))
+    comparison = {}
+    for path in sorted(current.keys() & previous.keys()):
+        change = (current[path] - previous[path]) / previous[path] if previous[path] else None
+        comparison[path] = {
+            "baseline": previous[path],
+            "current": current[path],
+            "change": None if change is None else round(change, 4),
+        }
+    return comparison
+
+
+def runner_pool(value):
+    try:
+        return [(category, int(count)) for category, count in (item.split("=") for item in value.split(","))]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected CATEGORY=COUNT,..., got {value!r}")
+
+
+def env_assignment(value):
+    name, sep, setting = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {value!r}")
+    return name, setting
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--service-log", help="append the log of the service under test here")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the synthetic data")
+    parser.add_argument("--env", type=env_assignment, action="append", default=[], metavar="NAME=VALUE",
+                        help="environment variable for the service under test, e.g."
+                             " FORWARDER_RUNNERS_PER_WORKFLOW=generic=1 (repeatable)")
+    scenarios = parser.add_subparsers(dest="scenario", required=True)
+
+    forwarder = scenarios.add_parser("forwarder", help="replay a webhook storm against the forwarder")
+    forwarder.add_argument("--events", type=int, default=2000, help="webhooks to send")
+    forwarder.add_argument("--changes", type=int, default=1500, help="distinct changes the patchsets belong to")
+    forwarder.add_argument("--owners", type=int, default=100, help="distinct change owners")
+    forwarder.add_argument("--comment-ratio", type=float, default=0.2,
+                           help="fraction of the events that are comment-added")
+    forwarder.add_argument("--false-positive-ratio", type=float, default=0.05,
+                           help="fraction of the comments that report a false positive")
+    forwarder.add_argument("--concurrency", type=int, default=16, help="concurrent webhook senders")
+    forwarder.add_argument("--rate", type=float,
+                           help="webhooks per second to send, spreading the storm over time; as fast as possible"
+                                " without it")
+    forwarder.add_argument("--max-workflows", type=int, default=50, help="FORWARDER_MAX_RUNNING_WORKFLOWS")
+    forwarder.add_argument("--cache-ttl", type=int, default=30,
+                           help="FORWARDER_WORKFLOW_RUNS_CACHE_TTL, the production default unless given")
+    forwarder.add_argument("--queue-interval", type=int, default=60,
+                           help="FORWARDER_QUEUE_PROCESS_INTERVAL, the production default unless given")
+    forwarder.add_argument("--runner-pool", type=runner_pool, metavar="CATEGORY=COUNT,...",
+                           help="self-hosted runners to simulate, e.g. generic=8,rdma=2; without it the runners API"
+                                " is unavailable and the forwarder falls back to --max-workflows")
+    forwarder.add_argument("--run-seconds", type=float, default=2, help="duration of each simulated workflow run")
+    forwarder.add_argument("--github-webhooks", action="store_true",
+                           help="report runs to the forwarder through workflow_run webhooks")
+    forwarder.add_argument("--timeout", type=float, default=600, help="seconds to wait for the queue to drain")
+
+    mergable = scenarios.add_parser("mergable_changes", help="poll a synthetic set of changes")
+    mergable.add_argument("--changes", type=int, default=500, help="open changes matching the ready query")
+    mergable.add_argument("--series-length", type=int, default=4, help="changes per series")
+    mergable.add_argument("--churn", type=int, default=5, help="changes updated per second")
+    mergable.add_argument("--passes", type=int, default=10, help="polls to run, the first one full")
+    mergable.add_argument("--interval", type=float, default=1, help="seconds between polls")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    started = datetime.datetime.now(datetime.timezone.utc)
+    if args.scenario == "forwarder":
+        results = benchmark_forwarder(args)
+    else:
+        results = benchmark_mergable_changes(args)
+
+    parameters = {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "service_log")}
+    parameters["env"] = dict(args.env)
+    if getattr(args, "runner_pool", None):
+        parameters["runner_pool"] = dict(args.runner_pool)
+    report = {
+        "scenario": args.scenario,
+        "started": started.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": parameters,
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["baseline"] = compare(results, json.load(f))
+
+    document = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(document + "\n")
+        logging.info(f"Wrote {args.output}")
+    else:
+        print(document)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        if sys.argv[2] == "forwarder":
+            run_forwarder_child(*sys.argv[3:])
+        else:
+            run_mergable_changes_child(*sys.argv[3:])
+    else:
+        main()
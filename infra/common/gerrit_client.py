@@ -0,0 +1,64 @@
+"""Gerrit REST access shared by the forwarder, mergable_changes and outdated_changes.
+
+connect() returns a pygerrit2 GerritRestAPI whose session keeps a pool of
+keep-alive connections and retries failed reads, and query_changes() streams
+the results of a /changes/ search page by page instead of fetching them in
+one request that Gerrit silently truncates.
+"""
+
+from urllib.parse import quote
+
+from pygerrit2 import GerritRestAPI
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_PAGE_SIZE = 500
+
+# Reads are retried on connection errors and on overload or gateway errors,
+# honouring Retry-After.  Writes are not retried: a repeated review POST
+# could post the same comment twice.  Once the retries are used up the last
+# response is returned, so callers still get the usual HTTPError.
+READ_RETRY = Retry(
+    total=3,
+    backoff_factor=1,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"GET", "HEAD"}),
+    raise_on_status=False,
+)
+
+
+def connect(url, auth=None, pool_size=10):
+    """Return a GerritRestAPI for url sharing one connection pool.
+
+    pool_size is the number of connections kept open, which should be at
+    least the number of threads issuing requests concurrently.
+    """
+    adapter = HTTPAdapter(max_retries=READ_RETRY, pool_connections=1, pool_maxsize=pool_size)
+    return GerritRestAPI(url=url, auth=auth, adapter=adapter)
+
+
+def query_changes(gerrit, query, options=(), page_size=DEFAULT_PAGE_SIZE):
+    """Yield every change matching a Gerrit search query.
+
+    options are the o= options to request (e.g. "CURRENT_REVISION"); ask
+    only for what the caller reads, since options like MESSAGES or
+    DETAILED_LABELS make each change much larger.  Pages of page_size
+    changes are requested with S=<offset> until Gerrit no longer marks the
+    last change with _more_changes, so at most one page is held in memory.
+
+    Each page is a separate request and retried on its own.  A change that
+    moves between pages while the query runs may be returned by two pages;
+    it is only yielded once.
+    """
+    opts = "".join(f"&o={option}" for option in options)
+    seen = set()
+    start = 0
+    while True:
+        page = gerrit.get(f"/changes/?q={quote(query, safe='')}{opts}&n={page_size}&S={start}")
+        for change in page:
+            if change["_number"] not in seen:
+                seen.add(change["_number"])
+                yield change
+        if not page or not page[-1].get("_more_changes"):
+            return
+        start += len(page)
@@ -0,0 +1,57 @@
+"""Rendering and publishing of the status pages served from OUTPUT_DIR.
+
+Shared by the forwarder and mergable_changes; each service image copies
+this module next to its own script.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+import jinja2
+
+# Templates ship inside the image and never change at runtime, so compile
+# each one once and skip the per-render mtime check.
+_environment = jinja2.Environment(loader=jinja2.FileSystemLoader("./"), auto_reload=False)
+
+# path -> digest of the content last written there by this process
+_written_digests: dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def render(template_name, **context):
+    """Render a template from the working directory using the cached environment."""
+    return _environment.get_template(template_name).render(**context)
+
+
+def publish(path, content):
+    """Atomically replace the file at path with content.
+
+    The content goes to a temp file in the same directory which is then
+    renamed over path, so a reader (nginx) never sees a partially written
+    file.  Nothing is written if the content is unchanged since the last
+    publish() of the same path.
+
+    Returns True if the file was written.
+    """
+    data = content.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    with _lock:
+        if _written_digests.get(path) == digest and os.path.exists(path):
+            return False
+
+        directory = os.path.dirname(path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            # mkstemp creates the file 0600; the web server must be able to read it
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        _written_digests[path] = digest
+        return True
@@ -0,0 +1,150 @@
+"""Versioned JSON status snapshots with delta queries and HTTP revalidation.
+
+A snapshot is made of keyed sections (e.g. pending changes by number),
+which are diffed entry by entry, and plain values (e.g. the projected
+dispatch order), which are replaced as a whole.  Every update that changes
+anything bumps the version, so pollers can ask for `?since=<version>` and
+receive only what changed, or revalidate with If-None-Match and get a 304.
+"""
+
+import email.utils
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class VersionedSnapshot:
+    # Removed-entry markers kept for delta queries; a `since` older than the
+    # oldest dropped marker is answered with a full snapshot instead.
+    MAX_TOMBSTONES = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Start from a clock-derived version so versions keep increasing
+        # across restarts and a poller's old `since` never aliases a new
+        # version; anything older than the start gets a full snapshot.
+        self.version = int(time.time() * 1000)
+        self.last_modified = int(time.time())
+        # section -> key -> (version changed, entry)
+        self._sections: dict[str, dict[str, tuple[int, object]]] = {}
+        # section -> key -> version removed
+        self._tombstones: dict[str, dict[str, int]] = {}
+        # name -> (version changed, value)
+        self._values: dict[str, tuple[int, object]] = {}
+        # Deltas can only be computed for `since` >= this version
+        self._delta_floor = self.version
+
+    def update(self, sections, values=None):
+        """Replace the snapshot contents.
+
+        sections maps a section name to {key: entry}; values maps a name to
+        any JSON-serializable value.  Returns the (possibly unchanged)
+        version.
+        """
+        with self._lock:
+            version = self.version + 1
+            changed = False
+
+            for name, entries in sections.items():
+                current = self._sections.setdefault(name, {})
+                tombstones = self._tombstones.setdefault(name, {})
+                entries = {str(key): entry for key, entry in entries.items()}
+                for key in current.keys() - entries.keys():
+                    del current[key]
+                    tombstones[key] = version
+                    changed = True
+                for key, entry in entries.items():
+                    if key not in current or current[key][1] != entry:
+                        current[key] = (version, entry)
+                        tombstones.pop(key, None)
+                        changed = True
+
+            for name, value in (values or {}).items():
+                if name not in self._values or self._values[name][1] != value:
+                    self._values[name] = (version, value)
+                    changed = True
+
+            if changed:
+                self.version = version
+                self.last_modified = int(time.time())
+                self._prune_tombstones()
+            return self.version
+
+    def _prune_tombstones(self):
+        count = sum(len(tombstones) for tombstones in self._tombstones.values())
+        if count <= self.MAX_TOMBSTONES:
+            return
+        removals = sorted((version, name, key)
+                          for name, tombstones in self._tombstones.items()
+                          for key, version in tombstones.items())
+        for version, name, key in removals[:count - self.MAX_TOMBSTONES]:
+            del self._tombstones[name][key]
+            self._delta_floor = max(self._delta_floor, version)
+
+    def document(self, since=None):
+        """Return the snapshot, or only the changes after version `since`."""
+        with self._lock:
+            full = since is None or since < self._delta_floor or since > self.version
+            since = 0 if full else since
+            return {
+                "version": self.version,
+                "since": None if full else since,
+                "full": full,
+                "sections": {
+                    name: {key: entry for key, (version, entry) in entries.items() if version > since}
+                    for name, entries in self._sections.items()
+                },
+                "removed": {} if full else {
+                    name: sorted(key for key, version in tombstones.items() if version > since)
+                    for name, tombstones in self._tombstones.items()
+                },
+                "values": {name: value for name, (version, value) in self._values.items() if version > since},
+            }
+
+
+def send_snapshot(handler, snapshot):
+    """Answer a GET on a BaseHTTPRequestHandler with the snapshot as JSON.
+
+    Honours `?since=<version>`, If-None-Match and If-Modified-Since.
+    """
+    etag = f'"{snapshot.version}"'
+    last_modified = email.utils.formatdate(snapshot.last_modified, usegmt=True)
+
+    not_modified = False
+    if_none_match = handler.headers.get("If-None-Match")
+    if_modified_since = handler.headers.get("If-Modified-Since")
+    if if_none_match is not None:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(",")]
+    elif if_modified_since is not None:
+        try:
+            not_modified = snapshot.last_modified <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            pass
+
+    if not_modified:
+        handler.send_response(304)
+        handler.send_header("ETag", etag)
+        handler.send_header("Last-Modified", last_modified)
+        handler.end_headers()
+        return
+
+    since = None
+    query = parse_qs(urlparse(handler.path).query)
+    if "since" in query:
+        try:
+            since = int(query["since"][0])
+        except ValueError:
+            handler.send_error(400, "since must be an integer version")
+            return
+
+    document = snapshot.document(since)
+    body = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    handler.send_response(200)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.send_header("Cache-Control", "no-cache")
+    handler.send_header("ETag", f'"{document["version"]}"')
+    handler.send_header("Last-Modified", last_modified)
+    handler.end_headers()
+    handler.wfile.write(body)
@@ -1,36 +1,61 @@
 #!/usr/bin/env python3
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Any
 from datetime import datetime, timedelta, timezone
-from pygerrit2 import GerritRestAPI
 import os
 import sys
 from dataclasses import dataclass, field
+import hashlib
+import hmac
 import json
 import requests
 import logging
+import logging.handlers
 import re
+import socket
 import threading
 import time
 import queue
-import jinja2
+from concurrent.futures import ThreadPoolExecutor
+import gerrit_client
+import prometheus_client
+import rendering
+import snapshots
+from urllib.parse import urlparse
+import heapq
 from collections import deque
 
+# Workflow started by dispatched events, whose active runs are throttled on
+WORKFLOW_FILE = "gerrit-webhook-handler.yml"
+
 @dataclass
 class ForwarderConfig:
     test_mode: bool = False
     log_level: str = "INFO"
     github_token: str = ""
     github_repo: str = "spdk/spdk-ci"
+    github_api_url: str = "https://api.github.com"
     queue_process_interval: int = 60
     max_running_workflows: int = 3
     output_dir: str = "/output"
     gerrit_url: str = "https://review.spdk.io"
     recovery_window_days: int = 7
     gerrit_query_limit: int = 300
+    workflow_runs_cache_ttl: int = 30
+    github_webhook_secret: str = ""
+    workflow_runs_reconcile_interval: int = 600
+    state_dir: str = "/var/lib/forwarder"
+    event_socket: str = "/run/spdk-ci/events.sock"
+    raw_archive: str = ""
+    raw_archive_max_bytes: int = 50 * 1024 * 1024
+    raw_archive_backups: int = 4
+    # shr_<category> runners used by each gerrit-webhook-handler run, see
+    # .github/scripts/detect_runners.sh
+    runners_per_workflow: dict[str, int] = field(default_factory=lambda: {"generic": 2})
     github_dispatch_url: str = field(init=False)
     github_workflow_runs_url: str = field(init=False)
+    github_runners_url: str = field(init=False)
 
     def __post_init__(self):
         self.test_mode = os.getenv("FORWARDER_TEST_MODE", str(self.test_mode)).lower() == "true"
@@ -42,24 +67,220 @@ class ForwarderConfig:
             sys.exit(1)
 
         self.github_repo = os.getenv("FORWARDER_GITHUB_REPO", self.github_repo)
-        github_repo_url = f"https://api.github.com/repos/{self.github_repo}"
+        self.github_api_url = os.getenv("FORWARDER_GITHUB_API_URL", self.github_api_url).rstrip("/")
+        github_repo_url = f"{self.github_api_url}/repos/{self.github_repo}"
         self.github_dispatch_url = f"{github_repo_url}/dispatches"
-        self.github_workflow_runs_url = f"{github_repo_url}/actions/workflows/gerrit-webhook-handler.yml/runs"
+        self.github_workflow_runs_url = f"{github_repo_url}/actions/workflows/{WORKFLOW_FILE}/runs"
+        self.github_runners_url = f"{github_repo_url}/actions/runners"
 
         self.output_dir = os.getenv("OUTPUT_DIR", self.output_dir)
+        self.state_dir = os.getenv("FORWARDER_STATE_DIR", self.state_dir)
+        self.event_socket = os.getenv("CHANGE_EVENT_SOCKET", self.event_socket)
+        self.raw_archive = os.getenv("FORWARDER_RAW_ARCHIVE", self.raw_archive)
+        self.github_webhook_secret = os.getenv("FORWARDER_GITHUB_WEBHOOK_SECRET", self.github_webhook_secret)
         self.gerrit_url = os.getenv("GERRIT_URL", self.gerrit_url).rstrip("/")
-        for attr in ['queue_process_interval', 'max_running_workflows', 'recovery_window_days', 'gerrit_query_limit']:
+        for attr in ['queue_process_interval', 'max_running_workflows', 'recovery_window_days', 'gerrit_query_limit',
+                     'workflow_runs_cache_ttl', 'raw_archive_max_bytes', 'raw_archive_backups',
+                     'workflow_runs_reconcile_interval']:
             try:
                 setattr(self, attr, int(os.getenv(f"FORWARDER_{attr.upper()}", str(getattr(self, attr)))))
             except Exception:
                 print(f"CRITICAL: FORWARDER_{attr.upper()} must be an integer.", file=sys.stderr)
                 sys.exit(1)
 
+        runners_per_workflow = os.getenv("FORWARDER_RUNNERS_PER_WORKFLOW")
+        if runners_per_workflow is not None:
+            try:
+                self.runners_per_workflow = {
+                    category.strip(): int(count)
+                    for category, count in (item.split("=") for item in runners_per_workflow.split(",") if item.strip())
+                }
+                if any(count <= 0 for count in self.runners_per_workflow.values()):
+                    raise ValueError
+            except ValueError:
+                print("CRITICAL: FORWARDER_RUNNERS_PER_WORKFLOW must be a comma-separated list of"
+                      " <category>=<positive integer>.", file=sys.stderr)
+                sys.exit(1)
+
 config = ForwarderConfig()
+# Route of the GitHub workflow_run webhook, see WebhookHandler.handle_workflow_run()
+GITHUB_WEBHOOK_PATH = "/github/workflow_run"
 # Matches run-name pattern "(12345/5)Subject" from gerrit-webhook-handler.yml
 DISPLAY_TITLE_RE = re.compile(r"^\((\d+)/(\d+)\)(.*)")
+# This matches the pattern used in parse_false_positive_comment.sh
+FALSE_POSITIVE_RE = re.compile(r"patch set \d+:\n\nfalse positive:\s*#?\d+$", re.IGNORECASE)
+# Attempts made by forward_events() before an event is given up on
+FORWARD_ATTEMPTS = 5
+# Gerrit events that can change whether a change is ready for merge;
+# republished to local subscribers such as mergable_changes.
+READINESS_EVENTS = {
+    "comment-added", "change-merged", "patchset-created", "change-abandoned", "change-restored",
+    "wip-state-changed", "private-state-changed",
+}
+
+event_queue: queue.Queue["QueuedEvent"] = queue.Queue()
+# Machine-readable view of the queue status page, served on /queue_status.json
+queue_snapshot = snapshots.VersionedSnapshot()
+# (journal id, event_type, payload) tuples forwarded to GitHub outside the
+# fair-scheduling queue (false positive comments, see project_comment()).
+forward_queue: queue.Queue[tuple[int, str, dict[str, Any]]] = queue.Queue()
+# Set whenever process_queue may have work to do: an event was enqueued or
+# a workflow slot freed up.  The queue_process_interval timer is only a
+# fallback reconciliation for changes nobody signals.
+dispatch_wakeup = threading.Event()
+# Raw webhook bodies, one JSON line each, kept out of the main log; only
+# written to when config.raw_archive is set, see open_raw_archive().
+raw_archive = logging.getLogger("forwarder.raw_archive")
+raw_archive.propagate = False
+
+# Metrics served on /metrics in the Prometheus text format
+WEBHOOKS = prometheus_client.Counter(
+    "forwarder_webhooks", "Webhook requests received, by Gerrit event type", ["type"])
+WEBHOOK_SECONDS = prometheus_client.Histogram(
+    "forwarder_webhook_seconds", "Time spent handling a webhook request")
+QUEUE_TICK_SECONDS = prometheus_client.Histogram(
+    "forwarder_queue_tick_seconds", "Duration of one process_queue pass")
+QUEUED_EVENTS = prometheus_client.Gauge(
+    "forwarder_queued_events", "Events waiting in the fair-scheduling queue")
+INBOX_EVENTS = prometheus_client.Gauge(
+    "forwarder_inbox_events", "Events received but not yet drained by process_queue")
+PENDING_FORWARDS = prometheus_client.Gauge(
+    "forwarder_pending_forwards", "Events waiting to be forwarded to GitHub as-is")
+ACTIVE_WORKFLOWS = prometheus_client.Gauge(
+    "forwarder_active_workflows", "Active workflow runs on GitHub, as last seen by process_queue")
+RUNNERS = prometheus_client.Gauge(
+    "forwarder_runners", "Self-hosted runners, by category and state (online, idle, busy)", ["category", "state"])
+DISPATCH_CAPACITY = prometheus_client.Gauge(
+    "forwarder_dispatch_capacity", "Workflows process_queue could dispatch, as of its last pass with events queued")
+OWNER_WAIT_SECONDS = prometheus_client.Gauge(
+    "forwarder_owner_wait_seconds", "Age of each owner's oldest queued event", ["owner"])
+TIME_IN_QUEUE_SECONDS = prometheus_client.Histogram(
+    "forwarder_time_in_queue_seconds", "Time from receiving an event to dispatching it",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800, float("inf")))
+DISPATCHES = prometheus_client.Counter(
+    "forwarder_dispatches", "Queued events posted to GitHub, by result", ["result"])
+FORWARDS = prometheus_client.Counter(
+    "forwarder_forwards", "Events forwarded to GitHub as-is, by result", ["result"])
+GITHUB_REQUESTS = prometheus_client.Counter(
+    "forwarder_github_requests", "GitHub API requests, by endpoint and HTTP status", ["endpoint", "status"])
+GITHUB_REQUEST_SECONDS = prometheus_client.Histogram(
+    "forwarder_github_request_seconds", "GitHub API request latency, by endpoint", ["endpoint"])
+WORKFLOW_RUNS_SECONDS = prometheus_client.Histogram(
+    "forwarder_workflow_runs_seconds", "Time to get the active workflow runs, including cache hits")
+SNAPSHOT_SECONDS = prometheus_client.Histogram(
+    "forwarder_snapshot_seconds", "Time to render and publish the queue status")
+GITHUB_WEBHOOKS = prometheus_client.Counter(
+    "forwarder_github_webhooks", "GitHub webhook requests received, by result", ["result"])
+RECOVERY_EVENTS = prometheus_client.Counter(
+    "forwarder_recovery_events", "Events enqueued by the Gerrit recovery scan")
+RECOVERY_SECONDS = prometheus_client.Gauge(
+    "forwarder_recovery_seconds", "Duration of the last Gerrit recovery scan")
+
+INBOX_EVENTS.set_function(lambda: event_queue.qsize())
+PENDING_FORWARDS.set_function(lambda: forward_queue.qsize())
+
+
+def github_request(endpoint, method, url, **kwargs):
+    """Send a request on github_session, recording its latency and status."""
+    with GITHUB_REQUEST_SECONDS.labels(endpoint).time():
+        try:
+            response = github_session.request(method, url, **kwargs)
+        except requests.RequestException:
+            GITHUB_REQUESTS.labels(endpoint, "error").inc()
+            raise
+    GITHUB_REQUESTS.labels(endpoint, str(response.status_code)).inc()
+    return response
+
+
+class QueuedEvent:
+    """A change event waiting for dispatch, projected to the fields in use.
+
+    Webhook bodies carry the whole change, commit message included, and an
+    event can wait in the queue for hours.  Only what the GitHub workflows
+    read (change number, subject and URL, patchset number, ref and creation
+    time) and what the queue itself needs (owner and change flags) is kept.
+    payload() rebuilds the client_payload dispatched to GitHub.
+    """
+
+    __slots__ = ("type", "change_number", "subject", "url", "owner", "wip", "private", "open", "status",
+                 "patchset_number", "patchset_ref", "patchset_created", "received")
+    FLAGS = ("wip", "private", "open", "status")
+
+    def __init__(self, event_type, change, patchset, received=None):
+        self.type = event_type
+        self.change_number = change.get("number")
+        self.subject = change.get("subject")
+        self.url = change.get("url")
+        self.owner = change.get("owner", {}).get("username")
+        self.wip = change.get("wip")
+        self.private = change.get("private")
+        self.open = change.get("open")
+        self.status = change.get("status")
+        self.patchset_number = patchset.get("number")
+        self.patchset_ref = patchset.get("ref")
+        self.patchset_created = patchset.get("createdOn")
+        self.received = received
+
+    @classmethod
+    def from_payload(cls, payload, received=None):
+        """Project a Gerrit event payload."""
+        return cls(payload.get("type"), payload.get("change", {}), payload.get("patchSet", {}), received)
+
+    @classmethod
+    def from_json(cls, data):
+        """Inverse of to_json(); also reads records holding a full payload."""
+        return cls.from_payload(data["payload"], data.get("received"))
+
+    def to_json(self):
+        return {"payload": self.payload(), "received": self.received}
+
+    def payload(self):
+        """Return the projected payload, in the shape of the Gerrit event."""
+        change = {
+            "number": self.change_number,
+            "subject": self.subject,
+            "url": self.url,
+            "owner": {"username": self.owner},
+        }
+        for flag in self.FLAGS:
+            if getattr(self, flag) is not None:
+                change[flag] = getattr(self, flag)
+        return {
+            "type": self.type,
+            "change": change,
+            "patchSet": {"number": self.patchset_number, "ref": self.patchset_ref, "createdOn": self.patchset_created},
+        }
+
+
+def project_comment(payload):
+    """Project a comment-added payload to the fields the false positives workflow reads."""
+    change = payload.get("change", {})
+    patchset = payload.get("patchSet", {})
+    return {
+        "type": payload.get("type"),
+        "change": {"number": change.get("number"), "subject": change.get("subject"), "url": change.get("url")},
+        "patchSet": {"number": patchset.get("number"), "ref": patchset.get("ref")},
+        "comment": payload.get("comment"),
+        "author": {"username": payload.get("author", {}).get("username")},
+    }
+
+
+def enqueue_event(event_data):
+    """Queue an event for dispatch and wake the dispatcher immediately."""
+    # Journaled with the event, so time in queue survives restarts
+    if event_data.received is None:
+        event_data.received = time.time()
+    # Journal and queue under one lock so the journal order is the order
+    # in which process_queue drains the events.
+    with journal.lock:
+        journal.record_event(event_data)
+        event_queue.put(event_data)
+    dispatch_wakeup.set()
+
 
-event_queue: queue.Queue[dict[str, Any]] = queue.Queue()
+def enqueue_forward(event_type, payload):
+    """Queue an event to be forwarded to GitHub as-is."""
+    forward_queue.put((journal.record_forward(event_type, payload), event_type, payload))
 
 
 def _github_headers():
@@ -69,21 +290,269 @@ def _github_headers():
     }
 
 
-def _get_workflow_runs():
-    """Fetch all active workflow runs (in_progress, waiting, queued) from GitHub."""
-    runs = []
-    for status in ("in_progress", "waiting", "queued"):
+# Pooled keep-alive connections to api.github.com, shared by all GitHub calls.
+github_session = requests.Session()
+github_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=8))
+gerrit = gerrit_client.connect(config.gerrit_url)
+
+
+def _get_github_listing(endpoint, url, params, previous=None):
+    """Fetch every page of a GitHub listing, e.g. workflow_runs or runners.
+
+    endpoint is also the key of the listed items in the response.  Returns
+    (pages, items), or None if the listing could not be fetched; pages
+    holds (etag, next_url, page_items) for each page.  previous is the
+    result of the last successful fetch: each page is requested with the
+    ETag it had then in If-None-Match and reused on 304, so every page is
+    revalidated but only the changed ones are transferred.
+    """
+    previous_pages = previous[0] if previous is not None else []
+    query = ", ".join(f"{name}={value}" for name, value in params.items())
+    next_url: str | None = url
+    pages = []
+    items = []
+    while next_url:
+        headers = _github_headers()
+        cached = previous_pages[len(pages)] if len(pages) < len(previous_pages) else None
+        if cached is not None and cached[0]:
+            headers["If-None-Match"] = cached[0]
         try:
-            response = requests.get(
-                config.github_workflow_runs_url, headers=_github_headers(),
-                params={"status": status, "per_page": 100})
-            if response.status_code == 200:
-                runs.extend(response.json().get("workflow_runs", []))
-            else:
-                logging.warning(f"Failed to query workflow runs (status={status}): {response.status_code}")
+            response = github_request(endpoint, "GET", next_url, headers=headers, params=params, timeout=30)
         except requests.RequestException as exc:
-            logging.warning(f"Error querying workflow runs (status={status}): {exc}")
-    return runs
+            logging.warning(f"Error querying {endpoint} ({query}): {exc}")
+            return None
+
+        if response.status_code == 304 and cached is not None:
+            # A 304 need not repeat the Link header, so follow the one
+            # the page had when it was fetched.
+            page = cached
+        elif response.status_code == 200:
+            # The "next" link already carries the query string.
+            page = (response.headers.get("ETag"), response.links.get("next", {}).get("url"),
+                    response.json().get(endpoint, []))
+        else:
+            logging.warning(f"Failed to query {endpoint} ({query}): {response.status_code}")
+            return None
+        pages.append(page)
+        items.extend(page[2])
+        next_url = page[1]
+        params = None
+
+    return pages, items
+
+
+class WorkflowRunsCache:
+    """Shared, TTL-bound view of the active workflow runs on GitHub.
+
+    Every consumer (dispatch throttling, status page, recovery) reads from
+    the same snapshot, so a queue tick hits the GitHub API at most once.
+    The per-status listings are fetched concurrently over a pooled session
+    and paginated to completion. Each page is sent with If-None-Match; an
+    unchanged page comes back as 304, which does not count against the
+    rate limit.
+
+    Runs reported by workflow_run webhooks (apply_webhook()) and runs just
+    dispatched (record_dispatch()) are laid over the listings, so the view
+    stays current between polls.  With webhooks configured the TTL is long
+    and polling only reconciles missed deliveries.
+    """
+
+    STATUSES = ("in_progress", "waiting", "queued")
+    # A webhook update overrides the listings for this long after a poll,
+    # since the listings can lag behind the webhooks.
+    WEBHOOK_SETTLE_SECONDS = 60
+    # A dispatched run counts as active until it shows up, or for this long
+    DISPATCH_GRACE_SECONDS = 120
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._fetched_at: float | None = None
+        # status -> (pages, workflow_runs) of the last successful fetch
+        self._responses: dict[str, tuple[list[Any], list[dict[str, Any]]]] = {}
+        # Guards the two tables below, which are updated from other threads
+        # while a poll holds _lock.
+        self._overlay_lock = threading.Lock()
+        # run id -> (received, run) from workflow_run webhooks
+        self._webhook_runs: dict[Any, tuple[float, dict[str, Any]]] = {}
+        # (change, patchset) -> (dispatched, subject) of runs not seen yet
+        self._dispatched: dict[tuple[int, int], tuple[float, str]] = {}
+
+    def _fetch_status(self, status):
+        """Fetch every page of runs with the given status.
+
+        Returns (pages, runs) as _get_github_listing() does, or None when
+        the request failed and the previous result for this status should
+        be kept.
+        """
+        return _get_github_listing("workflow_runs", config.github_workflow_runs_url,
+                                   {"status": status, "per_page": 100}, self._responses.get(status))
+
+    def apply_webhook(self, run):
+        """Record the state of a run from a workflow_run webhook.
+
+        Returns True if the run completed, freeing its slot.
+        """
+        with self._overlay_lock:
+            self._webhook_runs[run.get("id")] = (time.monotonic(), run)
+        return run.get("status") == "completed"
+
+    def record_dispatch(self, change_number, patchset_number, subject):
+        """Count a dispatched event as an active run until GitHub lists its run."""
+        with self._overlay_lock:
+            self._dispatched[(change_number, patchset_number)] = (time.monotonic(), subject or "")
+
+    def get(self):
+        """Return the cached runs, refreshing them first if the TTL expired."""
+        with self._lock:
+            now = time.monotonic()
+            if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+                with ThreadPoolExecutor(max_workers=len(self.STATUSES)) as executor:
+                    results = list(executor.map(self._fetch_status, self.STATUSES))
+                for status, result in zip(self.STATUSES, results):
+                    if result is not None:
+                        self._responses[status] = result
+                if all(result is not None for result in results):
+                    # The listings are authoritative for webhook updates
+                    # they have had time to catch up with.
+                    with self._overlay_lock:
+                        for run_id, (received, _) in list(self._webhook_runs.items()):
+                            if received < now - self.WEBHOOK_SETTLE_SECONDS:
+                                del self._webhook_runs[run_id]
+                self._fetched_at = now
+
+            # A run changing status between the concurrent queries can show
+            # up in two listings; keep one entry per run id.
+            runs_by_id = {}
+            for _, runs in self._responses.values():
+                for run in runs:
+                    runs_by_id.setdefault(run.get("id"), run)
+
+        with self._overlay_lock:
+            # Dispatches are matched to their runs, finished ones included,
+            # by the "(change/patchset)" prefix of the run name.
+            seen = set()
+            for run in list(runs_by_id.values()) + [run for _, run in self._webhook_runs.values()]:
+                m = DISPLAY_TITLE_RE.search(run.get("display_title", ""))
+                if m:
+                    seen.add((int(m.group(1)), int(m.group(2))))
+
+            for run_id, (_, run) in self._webhook_runs.items():
+                if run.get("status") == "completed":
+                    runs_by_id.pop(run_id, None)
+                else:
+                    runs_by_id[run_id] = run
+
+            now = time.monotonic()
+            placeholders = []
+            for key, (dispatched, subject) in list(self._dispatched.items()):
+                if key in seen or now - dispatched > self.DISPATCH_GRACE_SECONDS:
+                    del self._dispatched[key]
+                else:
+                    placeholders.append({
+                        "id": None,
+                        "status": "requested",
+                        "display_title": f"({key[0]}/{key[1]}){subject}",
+                        "html_url": "",
+                    })
+        return list(runs_by_id.values()) + placeholders
+
+    def invalidate(self):
+        """Force the next get() to revalidate against GitHub."""
+        with self._lock:
+            self._fetched_at = None
+
+
+workflow_runs_cache = WorkflowRunsCache(
+    config.workflow_runs_reconcile_interval if config.github_webhook_secret else config.workflow_runs_cache_ttl)
+
+
+def _get_workflow_runs():
+    """Return all active workflow runs (in_progress, waiting, queued) from GitHub."""
+    with WORKFLOW_RUNS_SECONDS.time():
+        return workflow_runs_cache.get()
+
+
+class RunnerPool:
+    """TTL-bound view of the self-hosted runners, and the workflows they can take.
+
+    Uses the reservation model of .github/scripts/detect_runners.sh: a
+    runner is in category <c> when it has the label shr_<c>, and each
+    active gerrit-webhook-handler run holds config.runners_per_workflow[c]
+    of them, either busy already or idle but about to be claimed.  The
+    listing is revalidated with If-None-Match like WorkflowRunsCache.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._fetched_at: float | None = None
+        # (pages, runners) of the last successful fetch
+        self._response: tuple[list[Any], list[dict[str, Any]]] | None = None
+
+    def counts(self):
+        """Return {category: (online, idle, busy)}, or None if the runners were never listed."""
+        with self._lock:
+            now = time.monotonic()
+            if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+                result = _get_github_listing("runners", config.github_runners_url, {"per_page": 100},
+                                             self._response)
+                if result is not None:
+                    self._response = result
+                self._fetched_at = now
+            if self._response is None:
+                return None
+            runners = self._response[1]
+
+        counts = {}
+        for category in config.runners_per_workflow:
+            label = f"shr_{category}"
+            online = [runner for runner in runners if runner.get("status") == "online"
+                      and any(runner_label.get("name") == label for runner_label in runner.get("labels", []))]
+            busy = sum(1 for runner in online if runner.get("busy"))
+            counts[category] = (len(online), len(online) - busy, busy)
+        return counts
+
+    def invalidate(self):
+        """Force the next counts() to revalidate against GitHub."""
+        with self._lock:
+            self._fetched_at = None
+
+    def free_workflows(self, active_workflows):
+        """Return how many more workflows the runners can take, or None if unknown.
+
+        Categories with no runner online are left out; when no category has
+        one, or the runners cannot be listed, the pool is unknown.
+        """
+        counts = self.counts()
+        if counts is None:
+            return None
+        free = []
+        for category, (online, idle, busy) in counts.items():
+            for state, count in (("online", online), ("idle", idle), ("busy", busy)):
+                RUNNERS.labels(category, state).set(count)
+            if not online:
+                continue
+            per_workflow = config.runners_per_workflow[category]
+            reserved = max(active_workflows * per_workflow - busy, 0)
+            free.append(max(idle - reserved, 0) // per_workflow)
+        return min(free) if free else None
+
+
+runner_pool = RunnerPool(config.workflow_runs_cache_ttl)
+
+
+def get_dispatch_capacity(active_workflows):
+    """Return how many queued events can be dispatched now.
+
+    As many as the self-hosted runner pool can take; when the pool is
+    unknown (no categories configured, runners API unavailable or no
+    runner online), up to config.max_running_workflows active runs.
+    """
+    free = runner_pool.free_workflows(active_workflows) if config.runners_per_workflow else None
+    if free is None:
+        return config.max_running_workflows - active_workflows
+    return free
 
 
 def post_event_to_github(event_type, payload):
@@ -97,7 +566,7 @@ def post_event_to_github(event_type, payload):
         return True
 
     try:
-        response = requests.post(config.github_dispatch_url, headers=_github_headers(), json=body)
+        response = github_request("dispatches", "POST", config.github_dispatch_url, headers=_github_headers(), json=body)
     except requests.RequestException as exc:
         logging.warning(f"GitHub action trigger failed with request error: {exc}")
         return False
@@ -110,6 +579,53 @@ def post_event_to_github(event_type, payload):
     return False
 
 
+# Unbound, non-blocking datagram socket used to publish change events
+change_event_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+change_event_socket.setblocking(False)
+
+
+def publish_change_event(event_type, payload):
+    """Tell local subscribers that a change's merge readiness may have changed.
+
+    Sends a small {"type", "change"} datagram to config.event_socket.  This is
+    best effort: with no subscriber listening, or its buffer full, the
+    notification is dropped, and subscribers fall back to polling Gerrit.
+    """
+    if not config.event_socket or event_type not in READINESS_EVENTS:
+        return
+    if event_type == "comment-added":
+        # Only comments that set or change a vote matter
+        approvals = payload.get("approvals") or []
+        if not any("oldValue" in a or str(a.get("value", "0")) != "0" for a in approvals):
+            return
+
+    message = {"type": event_type, "change": payload.get("change", {}).get("number")}
+    try:
+        change_event_socket.sendto(json.dumps(message).encode("utf-8"), config.event_socket)
+    except OSError as exc:
+        logging.debug(f"Not publishing {event_type} event: {exc}")
+
+
+def forward_events():
+    """Post events from forward_queue to GitHub off the webhook request path.
+
+    A failed post is retried with backoff so a slow or flaky GitHub API does
+    not lose the event.
+    """
+    while True:
+        forward_id, event_type, payload = forward_queue.get()
+        for attempt in range(FORWARD_ATTEMPTS):
+            if post_event_to_github(event_type, payload):
+                FORWARDS.labels("success").inc()
+                break
+            FORWARDS.labels("failure").inc()
+            time.sleep(2 ** attempt)
+        else:
+            FORWARDS.labels("given_up").inc()
+            logging.error(f"Giving up forwarding {event_type} event after {FORWARD_ATTEMPTS} attempts")
+        journal.record_forwarded(forward_id)
+
+
 def get_active_workflow_count():
     return len(_get_workflow_runs())
 
@@ -133,47 +649,51 @@ def _build_in_progress_rows():
     return rows
 
 
-def write_queue_snapshot(pending_events, dispatched_owners):
+@SNAPSHOT_SECONDS.time()
+def write_queue_snapshot(pending_events):
     in_progress_rows = _build_in_progress_rows()
 
-    # Simulate the fair-scheduling order on copies so we can display the
-    # estimated dispatch sequence without mutating the live state.
-    remaining = dict(pending_events)
-    owners_copy = deque(dispatched_owners)
+    # Show the estimated dispatch sequence, simulated without mutating the
+    # live queue.
     waiting_rows = []
-    while remaining:
-        selected = _select_fair_event(remaining, owners_copy)
-        event_data = remaining.pop(selected)
-        owner = _get_event_owner(event_data)
-        if owner in owners_copy:
-            owners_copy.remove(owner)
-        if owner is not None:
-            owners_copy.append(owner)
-
-        payload = event_data.get("payload", {})
-        change = payload.get("change", {})
-        patchset = payload.get("patchSet", {})
+    owner_received = {}
+    for selected, event_data in pending_events.projected_order():
+        owner = event_data.owner
+        received = event_data.received
+        if received is not None:
+            owner_received[owner or ""] = min(received, owner_received.get(owner or "", received))
         waiting_rows.append({
-            "change_url": change.get("url", ""),
+            "change_url": event_data.url or "",
             "change_number": selected,
-            "patchset_number": patchset.get("number", ""),
-            "subject": change.get("subject", ""),
+            "patchset_number": event_data.patchset_number or "",
+            "subject": event_data.subject or "",
             "owner": owner or "",
             "status": "Waiting",
             "run_url": "",
         })
 
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader("./"))
-    template = env.get_template("queue_status_template.html")
-    html = template.render(
+    html = rendering.render(
+        "queue_status_template.html",
         in_progress_rows=in_progress_rows,
         waiting_rows=waiting_rows,
         timestamp=time.strftime("%B %d %H:%M", time.gmtime()),
         interval=config.queue_process_interval,
     )
-
-    with open(os.path.join(config.output_dir, "queue_status.html"), "w") as f:
-        f.write(html)
+    rendering.publish(os.path.join(config.output_dir, "queue_status.html"), html)
+
+    QUEUED_EVENTS.set(len(pending_events))
+    now = time.time()
+    OWNER_WAIT_SECONDS.clear()
+    for owner, received in owner_received.items():
+        OWNER_WAIT_SECONDS.labels(owner).set(now - received)
+
+    queue_snapshot.update(
+        {
+            "in_progress": {f"{row['change_number']}/{row['patchset_number']}": row for row in in_progress_rows},
+            "waiting": {row["change_number"]: row for row in waiting_rows},
+        },
+        {"dispatch_order": [row["change_number"] for row in waiting_rows]},
+    )
 
 
 def _parse_gerrit_timestamp_to_unix(timestamp):
@@ -202,23 +722,16 @@ def _get_current_revision(change):
 
 
 def query_gerrit_for_recovery():
-    """Query Gerrit REST API for open changes without a Verified label."""
-    gerrit = GerritRestAPI(url=config.gerrit_url)
-    query = "".join([
-        "/changes/",
-        "?q=project:spdk/spdk status:open -is:wip -is:private"
-        " -label:Verified<0 -label:Verified>0"
-        f" -age:{config.recovery_window_days}d",
-        "&o=CURRENT_REVISION",
-        "&o=DETAILED_ACCOUNTS",
-        f"&n={config.gerrit_query_limit}",
-    ])
+    """Yield open changes without a Verified label from the Gerrit REST API."""
+    query = ("project:spdk/spdk status:open -is:wip -is:private"
+             " -label:Verified<0 -label:Verified>0"
+             f" -age:{config.recovery_window_days}d")
 
     try:
-        return gerrit.get(query)
+        yield from gerrit_client.query_changes(gerrit, query, ["CURRENT_REVISION", "DETAILED_ACCOUNTS"],
+                                               page_size=config.gerrit_query_limit)
     except Exception as exc:
         logging.warning(f"Error querying Gerrit: {exc}")
-        return []
 
 
 def list_recoverable_changes():
@@ -243,43 +756,38 @@ def build_recovery_event(change):
     """Build a minimal fake patchset-created event from a Gerrit REST API change object."""
     current_revision_data = _get_current_revision(change)
     if not current_revision_data:
-        return {}
+        return None
 
     patchset_created = _parse_gerrit_timestamp_to_unix(current_revision_data.get("created"))
     if patchset_created is None:
-        return {}
+        return None
 
     try:
         patchset_number = int(current_revision_data.get("_number"))
         change_number = int(change.get("_number"))
     except Exception:
-        return {}
+        return None
     patchset_ref = current_revision_data.get("ref")
     subject = change.get("subject")
     owner = change.get("owner", {}).get("username")
 
     if not all([patchset_ref, subject]):
-        return {}
+        return None
 
-    # Extend the fields below if GitHub workflows start using them
-    return {
-        "type": "patchset-created",
-        "change_number": change_number,
-        "payload": {
-            "type": "patchset-created",
-            "change": {
-                "number": change_number,
-                "subject": subject,
-                "url": f"{config.gerrit_url}/c/spdk/spdk/+/{change_number}",
-                "owner": {"username": owner},
-            },
-            "patchSet": {
-                "number": patchset_number,
-                "ref": patchset_ref,
-                "createdOn": patchset_created,
-            },
+    return QueuedEvent(
+        "patchset-created",
+        {
+            "number": change_number,
+            "subject": subject,
+            "url": f"{config.gerrit_url}/c/spdk/spdk/+/{change_number}",
+            "owner": {"username": owner},
         },
-    }
+        {
+            "number": patchset_number,
+            "ref": patchset_ref,
+            "createdOn": patchset_created,
+        },
+    )
 
 
 def get_active_workflow_changes():
@@ -294,132 +802,492 @@ def get_active_workflow_changes():
     return active
 
 
-def recover_queue():
-    """Enqueue recovery events from Gerrit for changes missing a Verified label."""
+def recover_queue(known_changes=frozenset()):
+    """Enqueue recovery events from Gerrit for changes missing a Verified label.
+
+    Changes in known_changes are already queued and are skipped.
+    """
+    started = time.monotonic()
     try:
         changes = list_recoverable_changes()
         events = [e for c in changes if (e := build_recovery_event(c))]
-        events.sort(key=lambda e: e["payload"]["patchSet"]["createdOn"])
+        events.sort(key=lambda e: e.patchset_created)
 
         active = get_active_workflow_changes()
         events = [e for e in events
-                  if (e["change_number"], e["payload"]["patchSet"]["number"]) not in active]
+                  if (e.change_number, e.patchset_number) not in active
+                  and e.change_number not in known_changes]
 
         for event in events:
-            event_queue.put(event)
+            enqueue_event(event)
+        RECOVERY_EVENTS.inc(len(events))
         logging.info(f"Recovery: enqueued {len(events)} events from Gerrit")
     except Exception as exc:
         logging.warning(f"Recovery failed (continuing startup): {exc}")
+    RECOVERY_SECONDS.set(time.monotonic() - started)
 
 
-def _get_event_owner(event_data):
-    """Return the change owner username, or None if missing."""
-    return event_data.get("payload", {}).get("change", {}).get("owner", {}).get("username")
+def restore_queue():
+    """Rebuild the pending queue at startup and return it.
 
+    When a journal exists it is replayed, and the Gerrit recovery scan only
+    runs in the background as a consistency check for changes the journal
+    does not know about (e.g. webhooks missed while the forwarder was down).
+    Without a journal the Gerrit scan is the sole source, as before.
+    """
+    pending_events = FairQueue()
+    try:
+        replayed = journal.replay(pending_events)
+    except (OSError, LookupError, TypeError) as exc:
+        logging.warning(f"Journal replay failed, falling back to Gerrit recovery: {exc}")
+        pending_events, replayed = FairQueue(), None
+
+    if replayed is None:
+        with journal.lock:
+            journal.compact(pending_events)
+        recover_queue()
+        return pending_events
+
+    inbox, forwards = replayed
+    # A dispatch can reach GitHub without making it into the journal; do
+    # not run such a change twice.
+    active = get_active_workflow_changes()
+    for change_number, event_data in pending_events.items():
+        if (change_number, event_data.patchset_number) in active:
+            pending_events.remove(change_number)
 
-def _get_change_flags(payload):
-    """Return change flags (wip/private/open/status) from an event payload."""
-    change = payload.get("change", {})
-    return {
-        "wip": change.get("wip"),
-        "private": change.get("private"),
-        "open": change.get("open"),
-        "status": change.get("status"),
-    }
+    with journal.lock:
+        journal.compact(pending_events)
+    for event_data in inbox:
+        enqueue_event(event_data)
+    for forward in forwards:
+        forward_queue.put(forward)
+    logging.info(f"Journal: restored {len(pending_events)} pending events, {len(inbox)} undrained events"
+                 f" and {len(forwards)} events to forward")
+
+    known_changes = {change_number for change_number, _ in pending_events.items()}
+    known_changes.update(event_data.change_number for event_data in inbox)
+    threading.Thread(target=recover_queue, args=(known_changes,), daemon=True).start()
+    return pending_events
 
 
 def _should_drop_event(event_data):
     """Return (drop, reason) based on events flags."""
-    flags = _get_change_flags(event_data.get("payload", {}))
-
-    if flags["wip"] is True:
+    if event_data.wip is True:
         return True, "wip"
 
-    if flags["private"] is True:
+    if event_data.private is True:
         return True, "private"
 
-    if flags["open"] is False:
+    if event_data.open is False:
         return True, "closed"
 
-    status = flags["status"]
+    status = event_data.status
     if status is not None and status != "NEW":
         return True, f"status={status}"
 
     return False, None
 
 
-def _select_fair_event(pending_events, dispatched_owners):
-    """Pick the next change_number to dispatch using owner-based round-robin.
+class FairQueue:
+    """Pending events keyed by change number, scheduled round-robin by owner.
 
-    New owners (not in dispatched_owners) get priority, in insertion order.
-    When all pending owners have been dispatched before, the one dispatched
-    longest ago (front of deque) goes next.
+    New owners (never dispatched since the queue last drained) go first, in
+    the order their oldest pending event arrived.  When every pending owner
+    has been dispatched before, the one dispatched longest ago goes next.
+    Within an owner, events keep their arrival order; replacing the event
+    of a queued change keeps its original position.  Events with a missing
+    owner are always treated as coming from a new owner.
 
-    Callers must ensure pending_events is non-empty; the function always
-    returns a valid change_number under that precondition.
+    Each owner has a FIFO bucket (a heap ordered by arrival), and owners are
+    picked from two heaps: new owners keyed by their oldest arrival and
+    dispatched owners keyed by their last dispatch.  Heap entries are
+    invalidated lazily, so push, remove and dispatch are all O(log n).
     """
-    # Pass 1: prefer events from owners we haven't dispatched yet.
-    # None owners (missing data) always pass this check and get priority.
-    for change_number, event_data in pending_events.items():
-        if _get_event_owner(event_data) not in dispatched_owners:
-            return change_number
-
-    # Pass 2: all pending owners are in the deque -- pick the one at the
-    # front (dispatched longest ago) that still has a pending event.
-    for candidate in dispatched_owners:
-        for change_number, event_data in pending_events.items():
-            if _get_event_owner(event_data) == candidate:
-                return change_number
-
-
-def process_queue():
-    pending_events: dict[int, dict[str, Any]] = {}
-    # Tracks which owners have been dispatched, ordered from least-recent
-    # (front) to most-recent (back).  Used by _select_fair_event() for
-    # round-robin selection.  Cleared only when the queue fully drains so
-    # that owners returning mid-cycle land in the right position.
-    dispatched_owners: deque[str] = deque()
 
-    while True:
-        time.sleep(config.queue_process_interval)
+    def __init__(self):
+        self._arrivals = 0
+        self._dispatches = 0
+        self._registrations = 0
+        # change_number -> (arrival, owner, event_data)
+        self._events: dict[int, tuple[int, str | None, QueuedEvent]] = {}
+        # owner -> heap of (arrival, change_number)
+        self._buckets: dict[str | None, list[tuple[int, int]]] = {}
+        # owner -> dispatch stamp, for owners dispatched since the last drain
+        self._last_dispatch: dict[str, int] = {}
+        # heap of (oldest arrival, tie-breaker, owner) for owners not
+        # dispatched yet; stale entries for a re-owned change may share an
+        # arrival, and None owners cannot be compared with names
+        self._new_owners: list[tuple[int, int, str | None]] = []
+        # heap of (dispatch stamp, owner) for owners dispatched before
+        self._dispatched_owners: list[tuple[int, str]] = []
+
+    def __len__(self):
+        return len(self._events)
+
+    def __contains__(self, change_number):
+        return change_number in self._events
+
+    def get(self, change_number):
+        """Return the pending event for a change."""
+        return self._events[change_number][2]
+
+    def items(self):
+        """Return [(change_number, event_data)] in arrival order."""
+        entries = sorted(self._events.items(), key=lambda item: item[1][0])
+        return [(change_number, event_data) for change_number, (_, _, event_data) in entries]
+
+    def dispatch_history(self):
+        """Return owners dispatched since the last drain, least recent first."""
+        return sorted(self._last_dispatch, key=self._last_dispatch.__getitem__)
+
+    def push(self, change_number, event_data):
+        """Queue an event, replacing any pending event for the same change."""
+        owner = event_data.owner
+        if change_number in self._events:
+            arrival, old_owner, _ = self._events[change_number]
+            self._events[change_number] = (arrival, owner, event_data)
+            if old_owner == owner:
+                return
+            self._refresh_owner(old_owner)
+        else:
+            arrival = self._arrivals
+            self._arrivals += 1
+            self._events[change_number] = (arrival, owner, event_data)
+        head = self._head(owner)
+        heapq.heappush(self._buckets.setdefault(owner, []), (arrival, change_number))
+        # An owner already queued keeps its registration unless the event
+        # becomes its oldest one, which only a re-owned change can do.
+        if head is None or arrival < head:
+            self._refresh_owner(owner)
+
+    def remove(self, change_number):
+        """Drop the pending event for a change, if any."""
+        entry = self._events.pop(change_number, None)
+        if entry is not None:
+            self._refresh_owner(entry[1])
+
+    def next_change(self):
+        """Return the change number that should be dispatched next.
+
+        The queue must not be empty.
+        """
+        while self._new_owners:
+            arrival, _, owner = self._new_owners[0]
+            if owner not in self._last_dispatch and self._head(owner) == arrival:
+                return self._buckets[owner][0][1]
+            heapq.heappop(self._new_owners)
 
+        while True:
+            stamp, owner = self._dispatched_owners[0]
+            if self._last_dispatch.get(owner) == stamp and self._head(owner) is not None:
+                return self._buckets[owner][0][1]
+            heapq.heappop(self._dispatched_owners)
+
+    def dispatch(self, change_number):
+        """Remove a change's event and record its owner as most recently dispatched."""
+        _, owner, event_data = self._events.pop(change_number)
+        self.mark_dispatched(owner)
+        return event_data
+
+    def mark_dispatched(self, owner):
+        """Record the owner as most recently dispatched."""
+        if owner is not None:
+            self._last_dispatch[owner] = self._dispatches
+            self._dispatches += 1
+        self._refresh_owner(owner)
+
+    def clear_history(self):
+        """Forget dispatch history so every owner starts fresh."""
+        self._last_dispatch.clear()
+        self._dispatched_owners.clear()
+        for owner in self._buckets:
+            self._refresh_owner(owner)
+
+    def projected_order(self):
+        """Return [(change_number, event_data)] in the order they would be dispatched."""
+        simulation = FairQueue()
+        simulation._arrivals = self._arrivals
+        simulation._dispatches = self._dispatches
+        simulation._registrations = self._registrations
+        simulation._events = dict(self._events)
+        simulation._buckets = {owner: list(bucket) for owner, bucket in self._buckets.items()}
+        simulation._last_dispatch = dict(self._last_dispatch)
+        simulation._new_owners = list(self._new_owners)
+        simulation._dispatched_owners = list(self._dispatched_owners)
+
+        order = []
+        while simulation:
+            change_number = simulation.next_change()
+            order.append((change_number, simulation.dispatch(change_number)))
+        return order
+
+    def _head(self, owner):
+        """Return the arrival of the owner's oldest pending event, or None."""
+        bucket = self._buckets.get(owner)
+        while bucket:
+            arrival, change_number = bucket[0]
+            entry = self._events.get(change_number)
+            if entry is not None and entry[0] == arrival and entry[1] == owner:
+                return arrival
+            heapq.heappop(bucket)
+        self._buckets.pop(owner, None)
+        return None
+
+    def _refresh_owner(self, owner):
+        """Re-register the owner in the heap matching its current state."""
+        head = self._head(owner)
+        if head is None:
+            return
+        if owner is None or owner not in self._last_dispatch:
+            heapq.heappush(self._new_owners, (head, self._registrations, owner))
+            self._registrations += 1
+        else:
+            heapq.heappush(self._dispatched_owners, (self._last_dispatch[owner], owner))
+
+
+class EventJournal:
+    """Append-only JSON-lines journal of the forwarder's queue state.
+
+    Records accepted events, the points where process_queue drained them,
+    dispatch decisions and false positive comments still to be forwarded.
+    Replaying it at startup rebuilds the pending queue, including the
+    fair-scheduling history, in O(events) without querying Gerrit.  The
+    journal is periodically compacted into the equivalent minimal record
+    set through a temp file and os.replace().  With no path configured all
+    methods are no-ops.
+
+    Callers must hold `lock` around record_event() and record_drain() so
+    the journal order matches the event_queue order.
+    """
+
+    # Rewrite the journal once it holds this many records
+    COMPACT_AFTER = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._file = None
+        self._records = 0
+        self._next_forward_id = 0
+        # id -> (event_type, payload) of forwards not completed yet
+        self._pending_forwards: dict[int, tuple[str, dict[str, Any]]] = {}
+
+    def _append(self, record):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        # Every record is on disk before its caller goes on, so a webhook
+        # is only acknowledged, and an event only counted as dispatched or
+        # forwarded, once it survives a crash or power loss.
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records += 1
+
+    def record_event(self, event_data):
+        self._append({"op": "event", "event": event_data.to_json()})
+
+    def record_drain(self, count):
+        self._append({"op": "drain", "count": count})
+
+    def record_dispatch(self, change_number):
+        with self.lock:
+            self._append({"op": "dispatch", "change_number": change_number})
+
+    def record_clear_history(self):
+        with self.lock:
+            self._append({"op": "clear_history"})
+
+    def record_forward(self, event_type, payload):
+        """Record an event to forward; returns its id for record_forwarded()."""
+        with self.lock:
+            forward_id = self._next_forward_id
+            self._next_forward_id += 1
+            self._pending_forwards[forward_id] = (event_type, payload)
+            self._append({"op": "forward", "id": forward_id, "type": event_type, "payload": payload})
+        return forward_id
+
+    def record_forwarded(self, forward_id):
+        with self.lock:
+            self._pending_forwards.pop(forward_id, None)
+            self._append({"op": "forwarded", "id": forward_id})
+
+    def replay(self, pending_events):
+        """Apply the journal to pending_events.
+
+        Returns (undrained events, unforwarded (id, type, payload) tuples),
+        or None when there is no journal to replay.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return None
+
+        inbox: deque[QueuedEvent] = deque()
+        forwards: dict[int, tuple[str, dict[str, Any]]] = {}
+        with open(self.path) as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Only the last line can be torn by a crash mid-write
+                    logging.warning(f"Journal: skipping unreadable record at line {line_number}")
+                    continue
+                op = record.get("op")
+                if op == "event":
+                    inbox.append(QueuedEvent.from_json(record["event"]))
+                elif op == "drain":
+                    for _ in range(min(record["count"], len(inbox))):
+                        _apply_event(pending_events, inbox.popleft())
+                elif op == "dispatch":
+                    if record["change_number"] in pending_events:
+                        pending_events.dispatch(record["change_number"])
+                elif op == "owner":
+                    pending_events.mark_dispatched(record["owner"])
+                elif op == "clear_history":
+                    pending_events.clear_history()
+                elif op == "forward":
+                    forwards[record["id"]] = (record["type"], record["payload"])
+                    self._next_forward_id = max(self._next_forward_id, record["id"] + 1)
+                elif op == "forwarded":
+                    forwards.pop(record["id"], None)
+
+        self._pending_forwards = forwards
+        return list(inbox), [(forward_id, *forward) for forward_id, forward in forwards.items()]
+
+    def compact(self, pending_events):
+        """Rewrite the journal as the minimal record set for the current state.
+
+        Must be called with `lock` held and event_queue drained.
+        """
+        if not self.path:
+            return
+        records = [{"op": "owner", "owner": owner} for owner in pending_events.dispatch_history()]
+        records += [{"op": "event", "event": event_data.to_json()} for _, event_data in pending_events.items()]
+        records.append({"op": "drain", "count": len(pending_events)})
+        records += [{"op": "forward", "id": forward_id, "type": event_type, "payload": payload}
+                    for forward_id, (event_type, payload) in self._pending_forwards.items()]
+
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            # The old journal is still complete; keep appending to it
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        finally:
+            self._file = open(self.path, "a")
+        self._records = len(records)
+
+    def needs_compaction(self):
+        return self._records >= self.COMPACT_AFTER
+
+
+journal = EventJournal(os.path.join(config.state_dir, "journal.jsonl") if config.state_dir else None)
+
+
+def _apply_event(pending_events, event_data):
+    """Add a drained event to the pending queue, or drop it per its flags."""
+    change_number = event_data.change_number
+    if change_number in pending_events:
+        logging.info(f"Replacing queued event for change {change_number}")
+    drop, reason = _should_drop_event(event_data)
+    if drop:
+        pending_events.remove(change_number)
+        logging.info(f"Dropping event for change {change_number} ({reason})")
+    else:
+        pending_events.push(change_number, event_data)
+
+
+def _process_queue_pass(pending_events):
+    """Drain event_queue into pending_events and dispatch what capacity allows.
+
+    Returns the seconds to wait for the next pass unless woken earlier.
+    """
+    tick_started = time.monotonic()
+
+    drained = []
+    with journal.lock:
         while True:
             try:
-                event_data = event_queue.get_nowait()
+                drained.append(event_queue.get_nowait())
             except queue.Empty:
                 break
-            change_number = event_data["change_number"]
-            if change_number in pending_events:
-                logging.info(f"Replacing queued event for change {change_number}")
-            pending_events[change_number] = event_data
-            drop, reason = _should_drop_event(event_data)
-            if drop:
-                del pending_events[change_number]
-                logging.info(f"Dropping event for change {change_number} ({reason})")
-
-        if pending_events:
-            to_send = config.max_running_workflows - get_active_workflow_count()
-            if to_send <= 0:
-                logging.info(f"Max workflows reached, deferring {len(pending_events)} events")
-            else:
-                while to_send > 0 and pending_events:
-                    selected = _select_fair_event(pending_events, dispatched_owners)
-                    event_data = pending_events[selected]
-                    if not post_event_to_github(event_data["type"], event_data["payload"]):
-                        break
-                    del pending_events[selected]
-                    owner = _get_event_owner(event_data)
-                    if owner in dispatched_owners:
-                        dispatched_owners.remove(owner)
-                    if owner is not None:
-                        dispatched_owners.append(owner)
-                    to_send -= 1
+        if drained:
+            journal.record_drain(len(drained))
+        for event_data in drained:
+            _apply_event(pending_events, event_data)
+        if journal.needs_compaction():
+            journal.compact(pending_events)
+
+    if pending_events:
+        active_workflows = get_active_workflow_count()
+        ACTIVE_WORKFLOWS.set(active_workflows)
+        to_send = get_dispatch_capacity(active_workflows)
+        DISPATCH_CAPACITY.set(max(to_send, 0))
+        if to_send <= 0:
+            logging.info(f"No capacity for more workflows ({active_workflows} active),"
+                         f" deferring {len(pending_events)} events")
         else:
-            # Queue fully drained -- reset round-robin so everyone starts
-            # fresh when new events arrive.
-            dispatched_owners.clear()
+            while to_send > 0 and pending_events:
+                selected = pending_events.next_change()
+                event_data = pending_events.get(selected)
+                if not post_event_to_github(event_data.type, event_data.payload()):
+                    DISPATCHES.labels("failure").inc()
+                    break
+                DISPATCHES.labels("success").inc()
+                if event_data.received is not None:
+                    TIME_IN_QUEUE_SECONDS.observe(time.time() - event_data.received)
+                pending_events.dispatch(selected)
+                journal.record_dispatch(selected)
+                workflow_runs_cache.record_dispatch(selected, event_data.patchset_number, event_data.subject)
+                if not config.github_webhook_secret:
+                    # Make the next read revalidate instead of trusting
+                    # the cache; with webhooks, the run reports itself.
+                    workflow_runs_cache.invalidate()
+                to_send -= 1
+    else:
+        # Queue fully drained -- reset round-robin so everyone starts
+        # fresh when new events arrive.
+        if pending_events.dispatch_history():
+            pending_events.clear_history()
+            journal.record_clear_history()
+
+    write_queue_snapshot(pending_events)
+    QUEUE_TICK_SECONDS.observe(time.monotonic() - tick_started)
+
+    # While events wait for a slot, reconcile at the cache TTL so a
+    # finished run is noticed quickly; revalidation is a cheap 304.
+    # workflow_run webhooks wake the loop themselves.
+    if pending_events and not config.github_webhook_secret:
+        return min(config.queue_process_interval, max(config.workflow_runs_cache_ttl, 1))
+    return config.queue_process_interval
+
+
+def process_queue(pending_events):
+    # Owner dispatch history is cleared only when the queue fully drains so
+    # that owners returning mid-cycle land in the right position.
+    wait_timeout = config.queue_process_interval
 
-        write_queue_snapshot(pending_events, dispatched_owners)
+    while True:
+        dispatch_wakeup.wait(timeout=wait_timeout)
+        # Clear before draining: anything enqueued from here on sets the
+        # flag again and triggers another pass right after this one.
+        dispatch_wakeup.clear()
+        # A failed pass (e.g. an unexpected GitHub response) must not stop
+        # dispatching for good; the events stay queued for the next pass.
+        try:
+            wait_timeout = _process_queue_pass(pending_events)
+        except Exception:
+            logging.exception("Processing the queue failed, retrying on the next pass")
+            wait_timeout = config.queue_process_interval
 
 
 class WebhookHandler(BaseHTTPRequestHandler):
@@ -428,46 +1296,133 @@ class WebhookHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b'Webhook received')
 
-    def do_POST(self):
-        logging.info(f"Received POST request on {self.path}")
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/queue_status.json":
+            snapshots.send_snapshot(self, queue_snapshot)
+        elif path == "/metrics":
+            body = prometheus_client.generate_latest()
+            self.send_response(200)
+            self.send_header("Content-Type", prometheus_client.CONTENT_TYPE_LATEST)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def handle_workflow_run(self, body):
+        """Apply a GitHub workflow_run webhook to workflow_runs_cache.
+
+        Deliveries must be signed with config.github_webhook_secret; the
+        route does not exist when no secret is configured.
+        """
+        if not config.github_webhook_secret:
+            self.send_error(404)
+            return
+        signature = self.headers.get("X-Hub-Signature-256", "")
+        expected = "sha256=" + hmac.new(config.github_webhook_secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, expected):
+            GITHUB_WEBHOOKS.labels("bad_signature").inc()
+            logging.warning("Rejecting GitHub webhook with an invalid signature")
+            self.send_error(401)
+            return
+
+        payload = json.loads(body.decode("utf-8"))
+        run = payload.get("workflow_run", {})
+        if (self.headers.get("X-GitHub-Event") != "workflow_run"
+                or payload.get("repository", {}).get("full_name") != config.github_repo
+                or os.path.basename(run.get("path", "").split("@")[0]) != WORKFLOW_FILE):
+            GITHUB_WEBHOOKS.labels("ignored").inc()
+            self.send_webhook_response()
+            return
 
+        GITHUB_WEBHOOKS.labels("applied").inc()
+        logging.info(f"Workflow run {run.get('id')} ({run.get('display_title')}) is {run.get('status')}")
+        if workflow_runs_cache.apply_webhook(run):
+            # The runners freed by the run may still be busy in the cached
+            # listing; relist them so the next pass can reuse the slot.
+            runner_pool.invalidate()
+            dispatch_wakeup.set()
+        self.send_webhook_response()
+
+    @WEBHOOK_SECONDS.time()
+    def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length)
+        if urlparse(self.path).path == GITHUB_WEBHOOK_PATH:
+            self.handle_workflow_run(post_data)
+            return
         payload = json.loads(post_data.decode('utf-8'))
-        logging.info(f"Request Body: {post_data.decode('utf-8')}")
+        if raw_archive.handlers:
+            raw_archive.info(json.dumps({"received": time.time(), "path": self.path, "body": payload},
+                                        separators=(",", ":")))
 
         event_type = payload.get("type")
+        logging.info(f"Received {event_type} event for change {payload.get('change', {}).get('number')}"
+                     f" on {self.path} ({content_length} bytes)")
+        WEBHOOKS.labels(event_type or "unknown").inc()
+        publish_change_event(event_type, payload)
 
         # Filter comment-added events: only forward if comment matches false positive pattern
         if event_type == "comment-added":
-            # This matches the pattern used in parse_false_positive_comment.sh
-            false_positive_pattern = re.compile(
-                r"patch set \d+:\n\nfalse positive:\s*#?\d+$",
-                re.IGNORECASE
-            )
             comment = payload.get("comment", "")
-            if not comment or not false_positive_pattern.search(comment):
+            if not comment or not FALSE_POSITIVE_RE.search(comment):
                 logging.info("Ignoring comment-added event: comment does not match false positive pattern")
             else:
-                post_event_to_github(event_type, payload)
+                enqueue_forward(event_type, project_comment(payload))
 
             self.send_webhook_response()
             return
 
-        change = payload.get("change", {})
-        change_number = change.get("number")
-        if not change.get("owner", {}).get("username"):
-            logging.warning(f"Event for change {change_number} is missing owner username")
-        event_data = {
-            "type": event_type,
-            "payload": payload,
-            "change_number": change_number,
-        }
-        event_queue.put(event_data)
+        event_data = QueuedEvent.from_payload(payload)
+        if not event_data.owner:
+            logging.warning(f"Event for change {event_data.change_number} is missing owner username")
+        enqueue_event(event_data)
 
         self.send_webhook_response()
 
-if __name__ == "__main__":
+
+class WebhookServer(ThreadingHTTPServer):
+    # socketserver's default listen backlog of 5 drops and delays
+    # connections during a burst of Gerrit deliveries.
+    request_queue_size = socket.SOMAXCONN
+
+
+def open_raw_archive():
+    """Start archiving raw webhook bodies if config.raw_archive is set.
+
+    The archive is rotated once it reaches raw_archive_max_bytes, keeping
+    raw_archive_backups old files, so it never grows past
+    (raw_archive_backups + 1) * raw_archive_max_bytes.
+    """
+    if not config.raw_archive:
+        return
+    handler = logging.handlers.RotatingFileHandler(config.raw_archive, maxBytes=config.raw_archive_max_bytes,
+                                                   backupCount=config.raw_archive_backups)
+    raw_archive.addHandler(handler)
+    raw_archive.setLevel(logging.INFO)
+
+
+def serve(port=8000):
+    """Restore the queue, start the worker threads and handle webhooks on port."""
+    open_raw_archive()
+    pending_events = restore_queue()
+
+    queue_thread = threading.Thread(target=process_queue, args=(pending_events,), daemon=True)
+    queue_thread.start()
+
+    forward_thread = threading.Thread(target=forward_events, daemon=True)
+    forward_thread.start()
+
+    # Each webhook is handled on its own thread so a slow request never
+    # holds up Gerrit's other deliveries.
+    server_address = ('', port)
+    httpd = WebhookServer(server_address, WebhookHandler)
+    logging.info(f"Starting webhook forwarder on port {port}...")
+    httpd.serve_forever()
+
+
+def main():
     logging.basicConfig(
         level=getattr(logging, config.log_level, logging.INFO),
         format="%(asctime)s - %(levelname)s - %(message)s",
@@ -476,13 +1431,8 @@ if __name__ == "__main__":
             logging.FileHandler("/var/log/forwarder.log", mode="a")
         ]
     )
+    serve()
 
-    recover_queue()
 
-    queue_thread = threading.Thread(target=process_queue, daemon=True)
-    queue_thread.start()
-
-    server_address = ('', 8000)
-    httpd = HTTPServer(server_address, WebhookHandler)
-    logging.info("Starting webhook forwarder on port 8000...")
-    httpd.serve_forever()
+if __name__ == "__main__":
+    main()
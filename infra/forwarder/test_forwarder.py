@@ -0,0 +1,250 @@
+"""Regression tests for the forwarder.
+
+Run from infra/forwarder with PYTHONPATH=../common:
+    python3 -m unittest test_forwarder
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from collections import deque
+from types import SimpleNamespace
+from unittest import mock
+
+os.environ.update({
+    "FORWARDER_GITHUB_TOKEN": "test",
+    "FORWARDER_STATE_DIR": "",
+    "CHANGE_EVENT_SOCKET": "",
+    "FORWARDER_RUNNERS_PER_WORKFLOW": "generic=2",
+})
+
+import forwarder
+
+
+def _response(status_code, json_body=None, etag=None, next_url=None):
+    response = mock.Mock(status_code=status_code, links={"next": {"url": next_url}} if next_url else {},
+                         headers={"ETag": etag} if etag else {})
+    response.json.return_value = json_body
+    return response
+
+
+RUNNERS = [
+    {"id": i, "status": "online", "busy": i < 1, "labels": [{"name": "self-hosted"}, {"name": "shr_generic"}]}
+    for i in range(4)
+]
+
+
+class RunnerPoolTest(unittest.TestCase):
+    def test_revalidates_and_keeps_runners_on_304(self):
+        pool = forwarder.RunnerPool(ttl=0)
+        responses = [_response(200, {"total_count": 4, "runners": RUNNERS}, etag='W/"abc"'),
+                     _response(304)]
+        with mock.patch.object(forwarder.github_session, "request", side_effect=responses) as request:
+            first = pool.counts()
+            second = pool.counts()
+
+        self.assertEqual(first, {"generic": (4, 3, 1)})
+        self.assertEqual(second, first)
+        self.assertNotIn("If-None-Match", request.call_args_list[0].kwargs["headers"])
+        self.assertEqual(request.call_args_list[1].kwargs["headers"]["If-None-Match"], 'W/"abc"')
+
+    def test_revalidates_every_page(self):
+        pool = forwarder.RunnerPool(ttl=0)
+        page_2 = [dict(runner, busy=True) for runner in RUNNERS[2:]]
+        responses = [_response(200, {"total_count": 4, "runners": RUNNERS[:2]}, etag='"p1"', next_url="page2"),
+                     _response(200, {"total_count": 4, "runners": RUNNERS[2:]}, etag='"p2"'),
+                     # The first page is unchanged; a runner on the second became busy
+                     _response(304),
+                     _response(200, {"total_count": 4, "runners": page_2}, etag='"p2b"')]
+        with mock.patch.object(forwarder.github_session, "request", side_effect=responses) as request:
+            first = pool.counts()
+            second = pool.counts()
+
+        self.assertEqual(first, {"generic": (4, 3, 1)})
+        self.assertEqual(second, {"generic": (4, 1, 3)})
+        urls = [call.args[1] for call in request.call_args_list]
+        self.assertEqual(urls, [forwarder.config.github_runners_url, "page2"] * 2)
+        etags = [call.kwargs["headers"].get("If-None-Match") for call in request.call_args_list]
+        self.assertEqual(etags, [None, None, '"p1"', '"p2"'])
+
+
+class ScanQueue:
+    """The scheduler FairQueue replaced: scans of a dict and an owner deque."""
+
+    def __init__(self):
+        self.pending = {}
+        self.dispatched_owners = deque()
+
+    def push(self, change_number, event_data):
+        self.pending[change_number] = event_data
+
+    def remove(self, change_number):
+        self.pending.pop(change_number, None)
+
+    def next_change(self):
+        for change_number, event_data in self.pending.items():
+            if event_data.owner not in self.dispatched_owners:
+                return change_number
+        for candidate in self.dispatched_owners:
+            for change_number, event_data in self.pending.items():
+                if event_data.owner == candidate:
+                    return change_number
+
+    def dispatch(self, change_number):
+        owner = self.pending.pop(change_number).owner
+        if owner in self.dispatched_owners:
+            self.dispatched_owners.remove(owner)
+        if owner is not None:
+            self.dispatched_owners.append(owner)
+
+    def clear_history(self):
+        self.dispatched_owners.clear()
+
+    def projected_order(self):
+        simulation = ScanQueue()
+        simulation.pending = dict(self.pending)
+        simulation.dispatched_owners = deque(self.dispatched_owners)
+        order = []
+        while simulation.pending:
+            change_number = simulation.next_change()
+            simulation.dispatch(change_number)
+            order.append(change_number)
+        return order
+
+
+class FairQueueTest(unittest.TestCase):
+    OWNERS = ["alice", "bob", "carol", "dave", None]
+
+    def test_matches_scan_order(self):
+        for seed in range(200):
+            rng = random.Random(seed)
+            fair, scan = forwarder.FairQueue(), ScanQueue()
+            for _ in range(150):
+                op = rng.random()
+                if op < 0.5:
+                    # New changes, and replacements that may change owner
+                    change_number = rng.randrange(30)
+                    event_data = SimpleNamespace(owner=rng.choice(self.OWNERS))
+                    fair.push(change_number, event_data)
+                    scan.push(change_number, event_data)
+                elif op < 0.6:
+                    change_number = rng.randrange(30)
+                    fair.remove(change_number)
+                    scan.remove(change_number)
+                elif op < 0.65:
+                    fair.clear_history()
+                    scan.clear_history()
+                elif scan.pending:
+                    change_number = scan.next_change()
+                    self.assertEqual(fair.next_change(), change_number, f"seed {seed}")
+                    self.assertIs(fair.dispatch(change_number), scan.pending[change_number])
+                    scan.dispatch(change_number)
+                self.assertEqual(len(fair), len(scan.pending))
+                self.assertEqual([change_number for change_number, _ in fair.projected_order()],
+                                 scan.projected_order(), f"seed {seed}")
+
+    def test_owners_start_fresh_after_clear_history(self):
+        queue = forwarder.FairQueue()
+        for change_number, owner in [(1, "alice"), (2, "bob"), (3, "alice"), (4, "bob")]:
+            queue.push(change_number, SimpleNamespace(owner=owner))
+        queue.dispatch(queue.next_change())
+        queue.dispatch(queue.next_change())
+        self.assertEqual(queue.dispatch_history(), ["alice", "bob"])
+
+        queue.clear_history()
+        queue.push(5, SimpleNamespace(owner="carol"))
+        queue.remove(3)
+        self.assertEqual(queue.dispatch_history(), [])
+        # Without history, owners go by their oldest pending event again
+        self.assertEqual([change_number for change_number, _ in queue.projected_order()], [4, 5])
+
+    def test_push_does_not_grow_owner_heaps(self):
+        queue = forwarder.FairQueue()
+        for change_number in range(100):
+            queue.push(change_number, SimpleNamespace(owner="alice"))
+        self.assertEqual(len(queue._new_owners), 1)
+
+
+def _event(change_number, owner, patchset_number=1):
+    return forwarder.QueuedEvent("patchset-created", {"number": change_number, "owner": {"username": owner}},
+                                 {"number": patchset_number})
+
+
+class EventJournalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "journal.jsonl")
+        self.journal = forwarder.EventJournal(self.path)
+        # Compacting the empty state creates the journal and opens it
+        self.journal.compact(forwarder.FairQueue())
+        self.addCleanup(lambda: self.journal._file.close())
+
+    def record_events(self, *events):
+        for event_data in events:
+            self.journal.record_event(event_data)
+        self.journal.record_drain(len(events))
+
+    def replay(self):
+        pending_events = forwarder.FairQueue()
+        inbox, forwards = forwarder.EventJournal(self.path).replay(pending_events)
+        return pending_events, inbox, forwards
+
+    def test_replay_drops_dispatched_events(self):
+        self.record_events(_event(1, "alice"), _event(2, "bob"), _event(3, "alice"))
+        self.journal.record_dispatch(1)
+        self.journal.record_event(_event(4, "carol"))
+
+        pending_events, inbox, _ = self.replay()
+
+        self.assertEqual([change_number for change_number, _ in pending_events.items()], [2, 3])
+        self.assertEqual(pending_events.dispatch_history(), ["alice"])
+        # Accepted but not drained yet
+        self.assertEqual([event_data.change_number for event_data in inbox], [4])
+
+    def test_replay_skips_truncated_last_line(self):
+        self.record_events(_event(1, "alice"), _event(2, "bob"))
+        self.journal.record_forward("comment-added", {"type": "comment-added"})
+        self.journal._file.write('{"op":"dispatch","change_')
+        self.journal._file.flush()
+
+        with self.assertLogs(level="WARNING"):
+            pending_events, _, forwards = self.replay()
+
+        self.assertEqual(len(pending_events), 2)
+        self.assertEqual(forwards, [(0, "comment-added", {"type": "comment-added"})])
+
+    def test_compaction_interrupted_before_replace_keeps_journal(self):
+        self.record_events(_event(1, "alice"), _event(2, "bob"))
+        self.journal.record_dispatch(1)
+        # A crash while the compacted journal was being written
+        with open(f"{self.path}.tmp", "w") as f:
+            f.write('{"op":"event","ev')
+
+        replayed, _, _ = self.replay()
+        self.assertEqual([change_number for change_number, _ in replayed.items()], [2])
+        self.assertEqual(replayed.dispatch_history(), ["alice"])
+
+        # The next compaction overwrites the leftover temp file
+        self.journal.compact(replayed)
+        replayed, _, _ = self.replay()
+        self.assertEqual([change_number for change_number, _ in replayed.items()], [2])
+        self.assertEqual(replayed.dispatch_history(), ["alice"])
+
+    def test_failed_compaction_keeps_appending_to_journal(self):
+        self.record_events(_event(1, "alice"), _event(2, "bob"))
+        pending_events, _, _ = self.replay()
+
+        with mock.patch.object(forwarder.os, "replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.journal.compact(pending_events)
+        self.assertFalse(os.path.exists(f"{self.path}.tmp"))
+
+        self.journal.record_dispatch(2)
+        replayed, _, _ = self.replay()
+        self.assertEqual([change_number for change_number, _ in replayed.items()], [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
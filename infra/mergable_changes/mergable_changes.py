@@ -1,21 +1,34 @@
 #!/usr/bin/env python3
 
+import io
+import json
 import os
+import socket
+import sys
 from dataclasses import dataclass, field
 import time
-import jinja2
+import gerrit_client
+import rendering
+import snapshots
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import datetime
-from typing import Dict
+from typing import Dict, Optional
 from prettytable import PrettyTable
 from requests import RequestException
-from pygerrit2 import GerritRestAPI
 
 @dataclass
 class MergableChangesConfig:
     log_level: str = "INFO"
     output_dir: str = "/output"
     gerrit_url: str = "https://review.spdk.io"
+    series_fetch_workers: int = 8
+    poll_interval: int = 30
+    full_refresh_interval: int = 1800
+    event_socket: str = "/run/spdk-ci/events.sock"
     gerrit_change_url: str = field(init=False)
 
     def __post_init__(self):
@@ -23,8 +36,26 @@ class MergableChangesConfig:
         self.output_dir = os.getenv("OUTPUT_DIR", self.output_dir)
         self.gerrit_url = os.getenv("GERRIT_URL", self.gerrit_url).rstrip("/")
         self.gerrit_change_url = f"{self.gerrit_url}/c"
+        self.event_socket = os.getenv("CHANGE_EVENT_SOCKET", self.event_socket)
+        for attr in ['series_fetch_workers', 'poll_interval', 'full_refresh_interval']:
+            try:
+                setattr(self, attr, int(os.getenv(f"MERGABLE_CHANGES_{attr.upper()}", str(getattr(self, attr)))))
+            except ValueError:
+                print(f"CRITICAL: MERGABLE_CHANGES_{attr.upper()} must be an integer.", file=sys.stderr)
+                sys.exit(1)
 
 config = MergableChangesConfig()
+# Machine-readable view of the status page, served on /mergable_changes.json
+status_snapshot = snapshots.VersionedSnapshot()
+# Port of the status JSON endpoint
+STATUS_PORT = 8001
+READY_QUERY = "project:spdk/spdk status:open label:Code-Review=2 label:Verified=1"
+# Incremental polls look back this much further than the previous poll
+# started, so updates racing with a poll are not missed.
+WATERMARK_OVERLAP = datetime.timedelta(seconds=60)
+# After the first change event, wait this long for more before refreshing,
+# so a burst of votes on a series becomes a single Gerrit query.
+EVENT_BATCH_DELAY = 1
 
 @dataclass
 class GerritChange:
@@ -39,6 +70,9 @@ class GerritChange:
     has_merge_conflict: bool = False
     needs_plus_two: bool = False
     ready: bool = False
+    current_revision: str = ""
+    parents: list = field(default_factory=list)
+    created: datetime.datetime = field(init=False)
     age: datetime.timedelta = field(init=False)
     hours: int = field(init=False)
     url: str = field(init=False)
@@ -46,8 +80,8 @@ class GerritChange:
     def __post_init__(self):
         first_revision = next(iter(self.revisions))
         created = datetime.datetime.strptime(first_revision['created'], '%Y-%m-%d %H:%M:%S.%f000')
-        created = created.replace(tzinfo=datetime.timezone.utc)
-        self.age = datetime.datetime.now(datetime.timezone.utc) - created
+        self.created = created.replace(tzinfo=datetime.timezone.utc)
+        self.age = datetime.datetime.now(datetime.timezone.utc) - self.created
         self.hours = self.age.seconds // 3600
         self.url = os.path.join(config.gerrit_change_url, self.project, '+', str(self.number))
 
@@ -67,6 +101,9 @@ class GerritChange:
         if not is_submittable or not is_mergeable:
             ready = False
 
+        current_revision = change_json['current_revision']
+        commit = change_json['revisions'][current_revision].get('commit', {})
+
         return cls(
             number=change_json['_number'],
             project=change_json['project'],
@@ -78,7 +115,9 @@ class GerritChange:
             has_minus_one=has_minus_one,
             has_merge_conflict=has_merge_conflict,
             needs_plus_two=needs_plus_two,
-            ready=ready
+            ready=ready,
+            current_revision=current_revision,
+            parents=[parent['commit'] for parent in commit.get('parents', [])]
         )
 
     @classmethod
@@ -97,85 +136,212 @@ class GerritChange:
             ready=False
         )
 
+def fetch_series(gerrit, number):
+    """Return the submitted_together list of a change, or None if it cannot be read."""
+    try:
+        query = "".join([
+            "/changes/", str(number), "/submitted_together", "?o=CURRENT_REVISION", "&o=CURRENT_COMMIT",
+            "&o=DETAILED_ACCOUNTS"
+        ])
+        return gerrit.get(query)
+    except RequestException:
+        # GET operation on /submitted_together can fail with 403 if there are patches which
+        # the caller cannot read, e.g. private changes. Bail out if this happens.
+        # TODO: Check if using NON_VISIBLE_CHANGES option could help.
+        # https://gerrit-review.googlesource.com/Documentation/rest-api-changes.html#submitted-together
+        return None
 
-    def check_parents_ready(self, gerrit, all_changes):
-        if self.ready:
-            try:
-                query = "".join([
-                    "/changes/", str(self.number), "/submitted_together", "?o=DETAILED_ACCOUNTS" 
-                ])
-                change_series = gerrit.get(query)
-            except RequestException:
-                # GET operation on /submitted_together can fail with 403 if there are patches which
-                # the caller cannot read, e.g. private changes. Bail out if this happens.
-                # TODO: Check if using NON_VISIBLE_CHANGES option could help.
-                # https://gerrit-review.googlesource.com/Documentation/rest-api-changes.html#submitted-together
-                pass
-
-            for change in reversed(change_series):
-                # submitted_together contains a list data for changes submitted together including the
-                # one currently inspected - skip it.
-                if self.number == change['_number']:
-                    continue
+def fetch_all_series(gerrit, numbers):
+    """Fetch the series of the given changes concurrently; returns {number: series}."""
+    with ThreadPoolExecutor(max_workers=config.series_fetch_workers) as executor:
+        results = executor.map(lambda number: fetch_series(gerrit, number), numbers)
+        return {number: series for number, series in zip(numbers, results) if series is not None}
 
-                parent_change = get_change_by_number(all_changes, change['_number'])
-                if not parent_change:
-                    # Looks like there's no +2'd parent changes so create a "blocking" one
-                    parent_change = GerritChange.blocking_change(change)
+def submitted_with(series, number):
+    """Return the numbers of the changes in series that must be submitted with change number.
+
+    That is the change's ancestors plus, for a change in a topic, the rest
+    of the topic and its ancestors: the submitted_together list Gerrit
+    returns for the change itself.
+    """
+    by_revision = {c['current_revision']: c for c in series if 'current_revision' in c}
+    by_topic = {}
+    for change_json in series:
+        if change_json.get('topic'):
+            by_topic.setdefault(change_json['topic'], []).append(change_json)
+    by_number = {c['_number']: c for c in series}
+    members = set()
+    pending = [by_number[number]] if number in by_number else []
+    while pending:
+        change_json = pending.pop()
+        if change_json['_number'] in members:
+            continue
+        members.add(change_json['_number'])
+        revision = change_json.get('revisions', {}).get(change_json.get('current_revision'), {})
+        pending.extend(by_revision[parent['commit']] for parent in revision.get('commit', {}).get('parents', [])
+                       if parent['commit'] in by_revision)
+        pending.extend(by_topic.get(change_json.get('topic'), []))
+    return members
 
-                if parent_change.ready is False:
-                    self.ready = False
-                    self.needs_plus_two = False
-                    self.blocked_by = parent_change
+def resolve_series(gerrit, all_changes, series_cache):
+    """Mark ready changes as blocked when another change in their series is not ready.
+
+    Each distinct series is fetched once: first for every ready change which
+    is not the parent of another change in all_changes (the series tips),
+    then for the ready changes those series did not cover.  The fetches run
+    concurrently.  A ready change is blocked by the oldest change it must be
+    submitted with (see submitted_with()) that is not ready or not in
+    all_changes, judged by readiness before any change is blocked.
+
+    series_cache maps a change number to its series and is kept across
+    polls; only series missing from it are fetched.  Callers drop entries
+    whose series may have changed.
+    """
+    parent_revisions = {parent for change in all_changes.values() for parent in change.parents}
+    ready = [c for c in all_changes.values() if c.ready]
+    tips = [c.number for c in ready if c.current_revision not in parent_revisions]
+    series_cache.update(fetch_all_series(gerrit, [number for number in tips if number not in series_cache]))
+
+    covered = set(tips)
+    covered.update(change['_number'] for number in tips for change in series_cache.get(number, []))
+    uncovered = [c.number for c in ready if c.number not in covered]
+    series_cache.update(fetch_all_series(gerrit, [number for number in uncovered if number not in series_cache]))
+
+    blockers = {}
+    for number in tips + uncovered:
+        if number not in series_cache:
+            continue
+        series = series_cache[number]
+        for member_json in series:
+            change = get_change_by_number(all_changes, member_json['_number'])
+            if not change or not change.ready or change.number in blockers:
+                continue
+            members = submitted_with(series, change.number)
+            # submitted_together lists the newest change first
+            for change_json in reversed(series):
+                if change_json['_number'] == change.number or change_json['_number'] not in members:
+                    continue
+                blocker = get_change_by_number(all_changes, change_json['_number'])
+                if not blocker:
+                    # Looks like there's no +2'd parent changes so create a "blocking" one
+                    blockers[change.number] = GerritChange.blocking_change(change_json)
                     break
+                if blocker.ready is False:
+                    blockers[change.number] = blocker
+                    break
+            else:
+                blockers[change.number] = None
+
+    for number, blocker in blockers.items():
+        if blocker is not None:
+            change = all_changes[number]
+            change.ready = False
+            change.needs_plus_two = False
+            change.blocked_by = blocker
 
-def get_gerrit_changes(gerrit, all_changes):
-    query = "".join([
-        "/changes/", "?q=project:spdk/spdk status:open label:Code-Review=2 label:Verified=1",
-        "&o=CURRENT_REVISION", "&o=DETAILED_LABELS", "&o=DETAILED_ACCOUNTS", "&o=SUBMITTABLE"
+def get_gerrit_changes(gerrit, query):
+    return gerrit_client.query_changes(gerrit, query, [
+        "CURRENT_REVISION", "CURRENT_COMMIT", "DETAILED_LABELS", "DETAILED_ACCOUNTS", "SUBMITTABLE"
     ])
-    changes_json = gerrit.get(query)
-    for change_json in changes_json:
-        change = GerritChange.from_json(change_json)
-        all_changes.append(change)
 
-def get_change_by_number(all_changes, number):
-    for change in all_changes:
-        if change.number == number:
-            return change
+@dataclass
+class ChangeCache:
+    """Gerrit data kept between polls so that most polls only fetch a delta."""
+    # change number -> change JSON, for the changes matching READY_QUERY
+    changes_json: Dict[int, Dict] = field(default_factory=dict)
+    # change number -> submitted_together series, see resolve_series()
+    series: Dict[int, list] = field(default_factory=dict)
+    watermark: Optional[datetime.datetime] = None
+    last_full_refresh: float = 0.0
+
+    def full_refresh(self, gerrit):
+        self.changes_json = {c['_number']: c for c in get_gerrit_changes(gerrit, READY_QUERY)}
+        self.series.clear()
+        self.last_full_refresh = time.monotonic()
 
-def get_ready_changes(all_changes):
-    return [c for c in all_changes if c.ready]
+    def refresh(self, gerrit):
+        """Bring the cache up to date with Gerrit.
 
-def get_needs_plus_two_changes(all_changes):
-    return [c for c in all_changes if c.needs_plus_two]
+        Asks Gerrit only for changes updated since the previous poll, plus a
+        full query every full_refresh_interval seconds.  Merged changes also
+        force a full query, since they can put other changes in merge
+        conflict without touching those changes' update time.
+        """
+        started = datetime.datetime.now(datetime.timezone.utc)
+        if self.watermark is None or time.monotonic() - self.last_full_refresh >= config.full_refresh_interval:
+            self.full_refresh(gerrit)
+        else:
+            after = f'after:"{self.watermark.strftime("%Y-%m-%d %H:%M:%S")}"'
+            self.update(gerrit, after)
+        self.watermark = started - WATERMARK_OVERLAP
 
-def get_minus_one_changes(all_changes):
-    return [c for c in all_changes if c.has_minus_one]
+    def refresh_changes(self, gerrit, numbers):
+        """Update the cache for just the given changes, e.g. after a webhook event."""
+        self.update(gerrit, "(" + " OR ".join(f"change:{number}" for number in sorted(numbers)) + ")")
 
-def get_merge_conflict_changes(all_changes):
-    return [c for c in all_changes if c.has_merge_conflict]
+    def update(self, gerrit, selector):
+        """Re-query the changes matching selector and update the cache with them."""
+        updated = gerrit_client.query_changes(gerrit, f"project:spdk/spdk {selector}")
+        updated_numbers = set()
+        for change in updated:
+            if change.get('status') == 'MERGED':
+                logging.info("Changes were merged, running a full query")
+                self.full_refresh(gerrit)
+                return
+            updated_numbers.add(change['_number'])
+        if updated_numbers:
+            for number in updated_numbers:
+                self.changes_json.pop(number, None)
+            for change_json in get_gerrit_changes(gerrit, f"{READY_QUERY} {selector}"):
+                self.changes_json[change_json['_number']] = change_json
+            # Re-fetch the series of updated changes and of every change
+            # stacked on top of one.
+            for number, series in list(self.series.items()):
+                if number in updated_numbers or any(c['_number'] in updated_numbers for c in series):
+                    del self.series[number]
+            logging.info(f"Updated {len(updated_numbers)} changes")
 
-def get_blocked_by_changes(all_changes):
-    return [c for c in all_changes if c.blocked_by]
+        for number in list(self.series):
+            if number not in self.changes_json:
+                del self.series[number]
+
+def get_change_by_number(all_changes, number):
+    return all_changes.get(number)
+
+def classify_changes(changes):
+    """Sort changes into the status page sections in a single pass."""
+    sections = {
+        "Changes ready for merge": [],
+        "Changes needing another +2 CR vote": [],
+        "Changes with a -1 CR vote": [],
+        "Changes with a merge conflict": [],
+        "Changes blocked by parents in series": []
+    }
+    ready, needs_plus_two, minus_one, merge_conflict, blocked = sections.values()
+    for c in changes:
+        if c.ready:
+            ready.append(c)
+        if c.needs_plus_two:
+            needs_plus_two.append(c)
+        if c.has_minus_one:
+            minus_one.append(c)
+        if c.has_merge_conflict:
+            merge_conflict.append(c)
+        if c.blocked_by:
+            blocked.append(c)
+    return sections
 
 def write_text_summary(all_changes):
     def write_and_log(line, fh):
         fh.write(line + "\n")
         logging.debug(line)
 
-    sections = {
-        "Changes ready for merge": get_ready_changes(all_changes),
-        "Changes needing another +2 CR vote": get_needs_plus_two_changes(all_changes),
-        "Changes with a -1 CR vote": get_minus_one_changes(all_changes),
-        "Changes with a merge conflict": get_merge_conflict_changes(all_changes),
-        "Changes blocked by parents in series": get_blocked_by_changes(all_changes)
-    }
+    sections = classify_changes(all_changes)
 
     timestamp = datetime.datetime.now(datetime.timezone.utc)
-    with open(os.path.join(config.output_dir, "mergable_changes.txt"), "w") as fh:
+    with io.StringIO() as fh:
         fh.write(f"Generated at {timestamp}\n")
-        fh.write("Contents are re-generated every 5 minutes.\n\n\n")
+        fh.write(f"Contents are re-generated every {config.poll_interval} seconds.\n\n\n")
         for section_name, changes in sections.items():
             write_and_log(f"{section_name}", fh)
             write_and_log("-" * len(section_name), fh)
@@ -197,10 +363,105 @@ def write_text_summary(all_changes):
             else:
                 write_and_log("No changes in this category.\n", fh)
 
-    template = jinja2.Environment(loader=jinja2.FileSystemLoader('./')).get_template("template.html")
-    with open(os.path.join(config.output_dir, "mergable_changes.html"), "w+") as output:
-        output.write(template.render(sections=sections, timestamp=timestamp.strftime("%B %d %H:%M")))
+        rendering.publish(os.path.join(config.output_dir, "mergable_changes.txt"), fh.getvalue())
+
+    html = rendering.render("template.html", sections=sections, timestamp=timestamp.strftime("%B %d %H:%M"),
+                            interval=config.poll_interval)
+    rendering.publish(os.path.join(config.output_dir, "mergable_changes.html"), html)
+
+    status_snapshot.update({
+        section_name: {change.number: change_summary(change) for change in changes}
+        for section_name, changes in sections.items()
+    })
+
+
+def change_summary(change):
+    """Return the JSON-serializable view of a change for the status snapshot."""
+    summary = {
+        "number": change.number,
+        "project": change.project,
+        "subject": change.subject,
+        "owner": change.owner,
+        "url": change.url,
+        "created": change.created.isoformat(),
+    }
+    if change.needs_plus_two:
+        summary["reviewed_by"] = change.reviewed_by
+    if change.blocked_by:
+        summary["blocked_by"] = change.blocked_by.url
+    return summary
+
+
+class ChangeEventListener:
+    """Receives change events republished by the forwarder.
+
+    The forwarder sends one {"type", "change"} JSON datagram per Gerrit event
+    that may affect merge readiness to a Unix socket on a volume shared by
+    both containers.  The listener collects the touched change numbers and
+    wakes the main loop, which then refreshes only those changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._changes: set[int] = set()
 
+    def start(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        # The forwarder runs in another container, possibly as another user
+        os.chmod(self.path, 0o666)
+        threading.Thread(target=self._receive, args=(sock,), daemon=True).start()
+        logging.info(f"Listening for change events on {self.path}")
+
+    def _receive(self, sock):
+        while True:
+            data = sock.recv(65536)
+            try:
+                number = int(json.loads(data)["change"])
+            except (ValueError, TypeError, KeyError):
+                logging.warning(f"Ignoring malformed change event: {data!r}")
+                continue
+            with self._lock:
+                self._changes.add(number)
+            self._wakeup.set()
+
+    def wait(self, timeout):
+        """Block until change events arrive or timeout expires; returns the touched change numbers."""
+        if self._wakeup.wait(timeout):
+            time.sleep(EVENT_BATCH_DELAY)
+        self._wakeup.clear()
+        with self._lock:
+            changes, self._changes = self._changes, set()
+        return changes
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path == "/mergable_changes.json":
+            snapshots.send_snapshot(self, status_snapshot)
+        else:
+            self.send_error(404)
+
+
+def publish_status(gerrit, cache):
+    """Classify the cached changes and write the status pages."""
+    # Rebuilt from the cached JSON on every poll, which is cheap and
+    # keeps readiness and ages current. Indexed by number for O(1)
+    # lookup while resolving series.
+    all_changes: Dict[int, GerritChange] = {
+        number: GerritChange.from_json(change_json) for number, change_json in cache.changes_json.items()
+    }
+    resolve_series(gerrit, all_changes, cache.series)
+    write_text_summary(sorted(all_changes.values(), key=lambda c: c.age, reverse=True))
 
 def main():
     logging.basicConfig(
@@ -212,15 +473,32 @@ def main():
         ]
     )
 
+    httpd = ThreadingHTTPServer(('', STATUS_PORT), StatusHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    listener = ChangeEventListener(config.event_socket)
+    listener.start()
+
+    gerrit = gerrit_client.connect(config.gerrit_url, pool_size=config.series_fetch_workers)
+    cache = ChangeCache()
+    touched: set[int] = set()
+    next_poll = time.monotonic()
     while True:
-        all_changes = []
-        gerrit = GerritRestAPI(url=config.gerrit_url)
-        get_gerrit_changes(gerrit, all_changes)
-        for change in all_changes:
-            change.check_parents_ready(gerrit, all_changes)
-        all_changes.sort(key=lambda c: c.age, reverse=True)
-        write_text_summary(all_changes)
-        time.sleep(300)
+        # After a failed poll, retry once the poll interval has passed
+        wait = config.poll_interval
+        try:
+            if touched and time.monotonic() < next_poll:
+                cache.refresh_changes(gerrit, touched)
+            else:
+                cache.refresh(gerrit)
+                next_poll = time.monotonic() + config.poll_interval
+            publish_status(gerrit, cache)
+            wait = max(next_poll - time.monotonic(), 0)
+        except RequestException as exc:
+            logging.warning(f"Error querying Gerrit: {exc}")
+        except Exception:
+            logging.exception("Polling Gerrit failed, retrying on the next poll")
+        touched = listener.wait(wait)
 
 if __name__ == '__main__':
     main()
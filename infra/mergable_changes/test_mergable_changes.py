@@ -0,0 +1,167 @@
+"""Regression tests for mergable_changes.
+
+Run from infra/mergable_changes with PYTHONPATH=../common:
+    python3 -m unittest test_mergable_changes
+"""
+
+import datetime
+import re
+import unittest
+from unittest import mock
+
+import mergable_changes
+
+
+def _change(number, parent=None, topic=None, ready=True):
+    revision = f"rev{number}"
+    return {
+        "_number": number,
+        "project": "spdk/spdk",
+        "subject": f"Change {number}",
+        "owner": {"name": "alice"},
+        "mergeable": True,
+        "submittable": ready,
+        "labels": {"Code-Review": {"all": [{"value": 2, "name": "bob"}]}},
+        "current_revision": revision,
+        "revisions": {revision: {
+            "created": "2026-01-01 00:00:00.000000000",
+            "commit": {"parents": [{"commit": f"rev{parent}" if parent else "base"}]},
+        }},
+        "topic": topic,
+    }
+
+
+def _gerrit(series):
+    """A Gerrit whose submitted_together lists are series[number]."""
+    def get(path):
+        number = int(re.match(r"/changes/(\d+)/submitted_together", path).group(1))
+        return series[number]
+    return mock.Mock(get=mock.Mock(side_effect=get))
+
+
+def _changes(*changes_json):
+    return {c["_number"]: mergable_changes.GerritChange.from_json(c) for c in changes_json}
+
+
+class ResolveSeriesTest(unittest.TestCase):
+    def test_relation_chain_blocks_only_changes_above(self):
+        chain = [_change(1), _change(2, parent=1, ready=False), _change(3, parent=2), _change(4, parent=3)]
+        all_changes = _changes(*chain)
+        # submitted_together lists the newest change first
+        gerrit = _gerrit({4: chain[::-1]})
+
+        mergable_changes.resolve_series(gerrit, all_changes, {})
+
+        self.assertTrue(all_changes[1].ready)
+        self.assertFalse(all_changes[2].ready)
+        self.assertEqual(all_changes[2].blocked_by, "")
+        for number in (3, 4):
+            self.assertFalse(all_changes[number].ready)
+            self.assertIs(all_changes[number].blocked_by, all_changes[2])
+        # Only the tip's series was fetched
+        self.assertEqual(gerrit.get.call_count, 1)
+
+    def test_topic_blocks_every_ready_member(self):
+        topic = [_change(10, topic="t"), _change(11, topic="t", ready=False), _change(12, topic="t")]
+        all_changes = _changes(*topic)
+
+        mergable_changes.resolve_series(_gerrit({n: topic[::-1] for n in (10, 11, 12)}), all_changes, {})
+
+        self.assertFalse(all_changes[11].ready)
+        for number in (10, 12):
+            self.assertFalse(all_changes[number].ready)
+            self.assertIs(all_changes[number].blocked_by, all_changes[11])
+
+    def test_member_without_votes_blocks_topic(self):
+        topic = [_change(20, topic="t"), _change(21, topic="t"), _change(22, parent=21, topic="t")]
+        # 20 is not in the READY_QUERY results
+        all_changes = _changes(*topic[1:])
+
+        mergable_changes.resolve_series(_gerrit({22: topic[::-1]}), all_changes, {})
+
+        for number in (21, 22):
+            self.assertFalse(all_changes[number].ready)
+            self.assertEqual(all_changes[number].blocked_by.number, 20)
+
+    def test_cached_series_are_not_fetched(self):
+        chain = [_change(1), _change(2, parent=1)]
+        gerrit = _gerrit({2: chain[::-1]})
+        series_cache = {}
+
+        mergable_changes.resolve_series(gerrit, _changes(*chain), series_cache)
+        mergable_changes.resolve_series(gerrit, _changes(*chain), series_cache)
+
+        self.assertEqual(list(series_cache), [2])
+        self.assertEqual(gerrit.get.call_count, 1)
+
+
+class FakeQueries:
+    """Stands in for gerrit_client.query_changes, recording the queries."""
+
+    def __init__(self, ready, updated=()):
+        self.ready = ready
+        self.updated = list(updated)
+        self.queries = []
+
+    def __call__(self, gerrit, query, options=()):
+        self.queries.append(query)
+        if query.startswith(mergable_changes.READY_QUERY):
+            return list(self.ready)
+        return list(self.updated)
+
+
+class ChangeCacheTest(unittest.TestCase):
+    def refresh(self, cache, queries):
+        with mock.patch.object(mergable_changes.gerrit_client, "query_changes", queries):
+            cache.refresh(mock.Mock())
+
+    def test_polls_after_watermark(self):
+        cache = mergable_changes.ChangeCache()
+        started = datetime.datetime.now(datetime.timezone.utc)
+        self.refresh(cache, FakeQueries([_change(1)]))
+        self.assertEqual(list(cache.changes_json), [1])
+
+        queries = FakeQueries([_change(1), _change(2)], updated=[{"_number": 2, "status": "NEW"}])
+        self.refresh(cache, queries)
+
+        after = re.fullmatch(r'project:spdk/spdk after:"(.*)"', queries.queries[0]).group(1)
+        after = datetime.datetime.strptime(after, "%Y-%m-%d %H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+        # The previous poll's start, less the overlap, to the second
+        watermark = started - mergable_changes.WATERMARK_OVERLAP
+        self.assertLessEqual(abs(after - watermark), datetime.timedelta(seconds=2))
+        self.assertEqual(queries.queries[1], f'{mergable_changes.READY_QUERY} after:"{after:%Y-%m-%d %H:%M:%S}"')
+        self.assertEqual(sorted(cache.changes_json), [1, 2])
+
+    def test_merged_change_forces_full_refresh(self):
+        cache = mergable_changes.ChangeCache()
+        self.refresh(cache, FakeQueries([_change(1), _change(2, parent=1)]))
+        cache.series[2] = [_change(2, parent=1), _change(1)]
+
+        queries = FakeQueries([_change(2, parent=1)], updated=[{"_number": 1, "status": "MERGED"}])
+        self.refresh(cache, queries)
+
+        self.assertEqual(queries.queries[1:], [mergable_changes.READY_QUERY])
+        self.assertEqual(list(cache.changes_json), [2])
+        self.assertEqual(cache.series, {})
+
+    def test_update_drops_series_of_updated_changes(self):
+        cache = mergable_changes.ChangeCache()
+        self.refresh(cache, FakeQueries([_change(n) for n in (1, 2, 3, 5)]))
+        cache.series = {
+            2: [_change(2, parent=1), _change(1)],
+            3: [_change(3)],
+            5: [_change(5)],
+        }
+
+        # 1 was updated, and 5 no longer matches READY_QUERY
+        updated = [{"_number": 1, "status": "NEW"}, {"_number": 5, "status": "NEW"}]
+        queries = FakeQueries([_change(1)], updated=updated)
+        self.refresh(cache, queries)
+
+        self.assertEqual(sorted(cache.changes_json), [1, 2, 3])
+        # 2 is stacked on 1, so its series may have changed
+        self.assertEqual(list(cache.series), [3])
+
+
+if __name__ == "__main__":
+    unittest.main()